@@ -1,13 +1,30 @@
-import copy
-import dill as pickle
+import atexit
+from collections import deque, OrderedDict
+import concurrent.futures
 from datetime import datetime
-import librosa
+import audio_import
+import blob_store
+import effects
+import export
+import heapq
+import itertools
+import json
+import math
 import numpy as np
 import os
+import perf_profile
+import pickle
+import queue
+import render_cache
 import sounddevice as sd
 import shlex
+import shutil
+import struct
 import threading
+import time
 import uuid
+import weakref
+import zlib
 
 # Constants
 CHUNK = 1024  # Frames per buffer
@@ -18,6 +35,35 @@ RATE = 44100  # Sample rate
 FIRST_CLICK_FREQ = 1500  # Frequency (Hz) for the first beat’s click
 REGULAR_CLICK_FREQ = 1000  # Frequency (Hz) for the rest of the clicks
 
+SPECULATIVE_IDLE_SECONDS = 0.5  # Wait between checks for speculative work
+SPECULATIVE_POLL_SECONDS = 0.05  # How soon a dropped render is cancelled
+PREWARM_DELAY_SECONDS = 3  # Let the UI come up before warming up effects
+LATENCY_COMPENSATION_SAMPLES = 8000  # Default latency compensation
+EXPORT_REPETITIONS = 8  # Loops written by an export unless told otherwise
+SCENE_BANK_BYTES = 256 * 1024 * 1024  # Memory for scenes kept in the bank
+QUANTIZE_OPTIONS = (None, "beat", "bar", "loop")  # Scheduled edit timing
+BEATS_PER_BAR = 4
+TRACK_POOL_SIZE = 2  # Tracks kept ready for recording
+METER_TRACKS = 64  # Tracks with a level meter
+METER_HZ = 20  # Rate the UI reads the meters at
+STATE_HISTORY = 256  # State versions whose changes 'StateLog' remembers
+TRACK_POOL_CHECK_SECONDS = 1  # Wait between checks of the loop length
+AUTOSAVE_DIR = os.path.join('loops', 'autosave')
+HISTORY_DIR = os.path.join('loops', 'history')  # Spilled undo audio
+AUTOSAVE_SECONDS = 1  # Wait between journal writes
+AUTOSAVE_COMPACT_BYTES = 32 * 1024 * 1024  # Journal size that triggers compaction
+HISTORY_BYTES = 64 * 1024 * 1024  # Memory for deleted tracks kept for undo
+HISTORY_LENGTH = 200  # Edits that can be undone
+
+# Track attributes 'LoopMachine.apply_batch' can set, with their types
+BATCH_TRACK_FIELDS = {
+    'name': (str, type(None)),
+    'is_muted': bool,
+    'pitch_shift': int,
+    'offset_beats': (int, float),
+    'stretch_engine': str,
+}
+
 
 def generate_click(sample_rate=RATE, duration_ms=50, *, frequency):
     """Generate a short click sound for the metronome."""
@@ -27,33 +73,57 @@ def generate_click(sample_rate=RATE, duration_ms=50, *, frequency):
     return click.reshape(-1, 1)  # Ensure mono output
 
 
-def generate_clicks(bpm: int, beats_per_loop: int):
-    """Generate a full click track matching the loop length, with the first
-    click pitched differently."""
-    samples_per_beat = int((60 / bpm) * RATE)
+class Metronome:
+    """Renders the click track block by block from two cached click samples.
+
+    Beat onsets are found arithmetically from the loop position, so nothing
+    loop-sized is ever allocated and tempo changes take effect immediately.
+    """
 
-    # Generate the first click using a different frequency.
-    first_click = generate_click(frequency=FIRST_CLICK_FREQ)
-    first_silence = np.zeros(
-        (samples_per_beat - len(first_click), 1), dtype=np.int16)
-    first_segment = np.vstack((first_click, first_silence))
+    def __init__(self, sample_rate=RATE):
+        self.first_click = generate_click(
+            sample_rate, frequency=FIRST_CLICK_FREQ)
+        self.regular_click = generate_click(
+            sample_rate, frequency=REGULAR_CLICK_FREQ)
+        self.sample_rate = sample_rate
 
-    # Generate the regular click for the other beats.
-    regular_click = generate_click(frequency=REGULAR_CLICK_FREQ)
-    regular_silence = np.zeros(
-        (samples_per_beat - len(regular_click), 1), dtype=np.int16)
-    regular_segment = np.vstack((regular_click, regular_silence))
+    def render(self, out, position: int, bpm: float, beats_per_loop: int,
+               frames_per_loop: int):
+        """Adds the clicks for the block starting at 'position' into 'out'.
 
-    # Build the full click track: first beat is first_segment; remaining beats use regular_segment.
-    segments = [first_segment] + \
-        [regular_segment for _ in range(beats_per_loop - 1)]
-    return np.vstack(segments)
+        Like the rest of the loop, frames past the end of the loop stay
+        silent until playback restarts at position 0.
+        """
+        samples_per_beat = (60 / bpm) * self.sample_rate
+        start = position % frames_per_loop
+        length = min(len(out), frames_per_loop - start)
+        self._render_segment(out[:length], start, samples_per_beat,
+                             beats_per_loop, frames_per_loop)
+
+    def _render_segment(self, out, start, samples_per_beat, beats_per_loop,
+                        frames_per_loop):
+        """Adds every click overlapping [start, start + len(out)) into 'out'.
+        Beat 'k' starts at int(k * samples_per_beat) so fractional beat
+        lengths never accumulate drift."""
+        end = start + len(out)
+        click_length = len(self.first_click)
+        first_beat = max(0, int((start - click_length) // samples_per_beat))
+        last_beat = min(beats_per_loop - 1, int((end - 1) // samples_per_beat))
+        for beat in range(first_beat, last_beat + 1):
+            onset = int(beat * samples_per_beat)
+            click = self.first_click if beat == 0 else self.regular_click
+            lo = max(onset, start)
+            hi = min(onset + click_length, end, frames_per_loop)
+            if lo < hi:
+                out[lo - start:hi - start] += click[lo - onset:hi - onset]
 
 
 class Track:
     def __init__(self, frames_per_loop: int, bpm: float):
         self.frames_per_loop = frames_per_loop
-        self.raw_buffer = np.zeros(
+        # In shared memory, so an engine process can hand it to the app
+        # without copying it, even while recording into it
+        self.raw_buffer = effects.shared_zeros(
             (self.frames_per_loop, CHANNELS), dtype=np.int16)
         self.buffer = self.raw_buffer
         self.is_muted = False
@@ -64,56 +134,116 @@ class Track:
         self.track_uid = uuid.uuid4()
         self.original_bpm = bpm  # BPM at the time of recording
         self.bpm = bpm           # Current target BPM
+        # The track's own loop length, which may differ from the loop's
+        self.beats_per_loop = max(
+            1, round(frames_per_loop / ((60 / bpm) * RATE)))
+        self.start_beat = 0  # Loop beat on which the buffer starts playing
+        self.stretch_engine = "librosa"  # One of 'effects.STRETCH_ENGINES'
         self._on_buffer_modified = None  # Called after 'buffer' has been modified
+        self._render_key = None  # Cache key of a render left out by pickling
 
     def apply_effects_async(self):
         """Offload pitch shifting and time stretching to a background thread
         and update the buffer when done."""
         def worker():
-            # If no effects are needed, just copy the raw buffer.
-            if self.offset_beats == 0 and self.pitch_shift == 0 and (self.original_bpm == self.bpm):
-                self.buffer = self.raw_buffer.copy()
+            # If no effects are needed, play the raw buffer directly.
+            if not self.has_effects():
+                self.buffer = self.raw_buffer
             else:
-                # Normalize and flatten the raw buffer.
-                y = self.raw_buffer.astype(np.float32) / 32767.0
-                y = y.flatten()
-
-                # Apply time stretching if BPM has changed.
-                if self.original_bpm != self.bpm:
-                    # Calculate stretch factor: new BPM divided by original BPM.
-                    # For example, if originally recorded at 120 BPM and now at 100 BPM,
-                    # the factor will be 100/120 ≈ 0.833, which slows down the audio.
-                    stretch_factor = self.bpm / self.original_bpm
-                    y = librosa.effects.time_stretch(y, rate=stretch_factor)
-
-                # Apply pitch shifting if needed.
-                if self.pitch_shift != 0:
-                    y = librosa.effects.pitch_shift(
-                        y, sr=RATE, n_steps=self.pitch_shift)
-
-                # Apply offset if needed.
-                if self.offset_beats != 0:
-                    offset_samples = int(
-                        self.offset_beats * (60 / self.bpm) * RATE)
-                    y = np.roll(y, -offset_samples)
-
-                # Convert back to int16.
-                self.buffer = (np.clip(y, -1, 1) *
-                               32767).astype(np.int16).reshape(-1, 1)
+                self.buffer = render_cache.render(
+                    self.raw_buffer, RATE, *self.effect_state())
 
             if self._on_buffer_modified:
                 self._on_buffer_modified(self)
 
         threading.Thread(target=worker, daemon=True).start()
 
+    def has_effects(self):
+        """Returns True if the buffer has to be rendered from the raw buffer."""
+        return (self.offset_beats != 0 or self.pitch_shift != 0
+                or self.original_bpm != self.bpm)
+
+    def effect_state(self):
+        """Returns the parameters the rendered buffer depends on, in the
+        order 'effects.render_effects' takes them."""
+        return (self.bpm, self.original_bpm, self.pitch_shift,
+                self.offset_beats, self.stretch_engine)
+
+    def duplicate(self):
+        """Returns a copy-on-write duplicate of the track with a new uid.
+
+        The duplicate shares the raw and rendered arrays with this track.
+        Renders always produce a new array, so it only gets its own buffer
+        once its effects diverge.
+        """
+        # Not 'copy.copy', which would leave out a cached render, see
+        # '__getstate__'
+        duplicate = Track.__new__(Track)
+        duplicate.__dict__.update(self.__dict__)
+        duplicate.track_uid = uuid.uuid4()
+        duplicate.is_recording = False
+        return duplicate
+
+    def memory_usage(self, seen=None):
+        """Returns the bytes held in RAM by the track's raw and rendered
+        buffers. Arrays whose id is already in 'seen' are shared with
+        another track and are not counted again; memory-mapped arrays are
+        paged by the OS and count as 0."""
+        seen = set() if seen is None else seen
+
+        def nbytes(array):
+            if (array is None or id(array) in seen
+                    or TrackStorage.is_mapped(array)):
+                return 0
+            seen.add(id(array))
+            return array.nbytes
+
+        return {
+            'raw': nbytes(self.raw_buffer),
+            'rendered': nbytes(self.buffer),
+        }
+
     def __getstate__(self):
         """Creates a snapshot of the current state of object for pkl
         to access object data."""
         # Pickle uses this dunder method to access object data
         state = self.__dict__.copy()
         state['_on_buffer_modified'] = None
+        # A render known to be in the cache is read back by 'load_render'
+        # instead of being saved twice
+        key = render_cache.key_of(self.buffer)
+        if (key and self.buffer is not self.raw_buffer
+                and not TrackStorage.is_mapped(self.buffer)):
+            state['buffer'] = None
+            state['_render_key'] = key
         return state
 
+    def __setstate__(self, state):
+        """Restores a pickled track, filling in attributes added since it
+        was saved. A rendered buffer left out is filled in by
+        'load_render'."""
+        state.setdefault('stretch_engine', "librosa")
+        state.setdefault('beats_per_loop', max(1, round(
+            len(state['raw_buffer']) / ((60 / state['original_bpm']) * RATE)))
+            if state.get('raw_buffer') is not None else 1)
+        state.setdefault('start_beat', 0)
+        state.setdefault('_render_key', None)
+        self.__dict__.update(state)
+
+    def load_render(self):
+        """Fills in a rendered buffer left out when the track was pickled,
+        from the render cache. If it was evicted since, the raw buffer
+        plays until the track has been rendered again."""
+        if self.buffer is not None or self.raw_buffer is None:
+            return
+        key, self._render_key = self._render_key, None
+        buffer = render_cache.load_key(key) if key else None
+        if buffer is not None:
+            self.buffer = buffer
+        else:
+            self.buffer = self.raw_buffer
+            self.apply_effects_async()
+
     def __str__(self):
         """Provides a string representation of the object."""
         elements = []
@@ -130,9 +260,1108 @@ class Track:
             elements.append("o" + str(self.offset_beats))
         if self.bpm != self.original_bpm:
             elements.append(f"t*{self.bpm / self.original_bpm:.3f}")
+        if self.stretch_engine != "librosa":
+            elements.append(self.stretch_engine)
         return "<" + " ".join(elements) + ">"
 
 
+class SpeculativeRenderer:
+    """Pre-renders every track at the neighbouring tempos while the CPU is
+    idle, so a tempo change that hits the cache needs no rendering.
+
+    Renders run one at a time in a low priority process, pause while a
+    batch render runs, and are dropped as soon as a real render starts.
+    Results are kept in a least recently used cache of 'max_bytes' and
+    written to 'render_cache', which is read first. Only as many tempos
+    and tracks as fit in 'max_bytes' are rendered, so the renders never
+    evict each other.
+    """
+
+    def __init__(self, loop_machine, tempo_steps=(10, -10),
+                 max_bytes=64 * 1024 * 1024):
+        self.loop_machine = loop_machine
+        self.tempo_steps = tempo_steps  # e.g. (10, -10, 20, -20) to look further
+        self.max_bytes = max_bytes
+        self.is_enabled = True
+        self.cache = OrderedDict()  # Render key -> (raw buffer ref, buffer)
+        self.cache_bytes = 0
+        self._lock = threading.Lock()
+        self._failed = set()  # Keys whose render raised, not tried again
+        self._is_dropped = False
+        self._is_running = True
+        threading.Thread(target=self._run, daemon=True).start()
+
+    @staticmethod
+    def _key(track, bpm):
+        """Returns the cache key for rendering 'track' at 'bpm'."""
+        return (track.track_uid, bpm) + track.effect_state()[1:]
+
+    def lookup(self, track, bpm):
+        """Returns the cached render of 'track' at 'bpm', or None."""
+        key = self._key(track, bpm)
+        with self._lock:
+            entry = self.cache.get(key)
+            if entry is None or entry[0]() is not track.raw_buffer:
+                return None
+            self.cache.move_to_end(key)
+            return entry[1]
+
+    def drop(self):
+        """Drops the speculative render in progress so real work gets the
+        CPU. Only sets a flag, so the audio callback may call it too; the
+        renderer's own thread cancels the render."""
+        self._is_dropped = True
+
+    def stop(self):
+        """Stops speculating."""
+        self._is_running = False
+        self.drop()
+
+    def nbytes(self, track):
+        """Returns the bytes cached for 'track'."""
+        with self._lock:
+            return sum(buffer.nbytes for key, (_, buffer) in self.cache.items()
+                       if key[0] == track.track_uid)
+
+    def _store(self, key, raw_buffer, buffer):
+        """Caches a render, evicting the least recently used ones."""
+        with self._lock:
+            self.cache[key] = (weakref.ref(raw_buffer), buffer)
+            self.cache_bytes += buffer.nbytes
+            while self.cache_bytes > self.max_bytes:
+                _, (_, evicted) = self.cache.popitem(last=False)
+                self.cache_bytes -= evicted.nbytes
+
+    def _next_job(self):
+        """Returns the next (track, bpm) worth rendering, or None once
+        the renders wanted so far fill 'max_bytes'."""
+        loop_machine = self.loop_machine
+        budget = self.max_bytes
+        for step in self.tempo_steps:
+            bpm = loop_machine.target_bpm + step
+            if bpm <= 0:
+                continue
+            for track in list(loop_machine.tracks):
+                if (track is loop_machine.current_track
+                        or (track.original_bpm == bpm
+                            and track.pitch_shift == 0
+                            and track.offset_beats == 0)):
+                    continue
+                raw_buffer = track.raw_buffer
+                budget -= effects.rendered_length(
+                    len(raw_buffer), RATE, bpm, track.original_bpm) * (
+                        raw_buffer.nbytes // max(len(raw_buffer), 1))
+                if budget < 0:
+                    return None
+                key = self._key(track, bpm)
+                if key not in self.cache and key not in self._failed:
+                    return track, bpm
+        return None
+
+    def _run(self):
+        """Renders one neighbouring tempo after another while idle."""
+        while self._is_running:
+            job = None
+            if self.is_enabled and self.loop_machine.render_progress is None:
+                job = self._next_job()
+            if job is None:
+                time.sleep(SPECULATIVE_IDLE_SECONDS)
+                continue
+            track, bpm = job
+            key = self._key(track, bpm)
+            raw_buffer = track.raw_buffer
+            self._is_dropped = False
+            try:
+                buffer = self._render(raw_buffer, key[1:])
+            except Exception as error:
+                print(f"Speculative render failed: {error!r}")
+                self._failed.add(key)
+                continue
+            if buffer is not None and not self._is_dropped:
+                self._store(key, raw_buffer, buffer)
+
+    def _render(self, raw_buffer, effect_state):
+        """Returns the render from 'render_cache', or renders it and
+        adds it there. Returns None if it was dropped."""
+        # Rendered whole, like the batch render of a tempo change
+        buffer = render_cache.load(raw_buffer, RATE, effect_state,
+                                   render_cache.WHOLE)
+        if buffer is not None:
+            return buffer
+        try:
+            render = effects.SharedRender(
+                effects.get_process_pool(low_priority=True),
+                (raw_buffer,) + effect_state, RATE)
+        except RuntimeError:
+            # The pool has shut down with the interpreter
+            self._is_running = False
+            return None
+        buffer = self._wait(render)
+        if buffer is not None and not self._is_dropped:
+            render_cache.store(raw_buffer, RATE, effect_state, buffer,
+                               render_cache.WHOLE)
+        return buffer
+
+    def _wait(self, render):
+        """Returns the render's buffer, or None if it was dropped."""
+        while True:
+            if self._is_dropped or not self._is_running:
+                render.cancel()
+                return None
+            try:
+                return render.result(SPECULATIVE_POLL_SECONDS)
+            except concurrent.futures.TimeoutError:
+                continue
+            except concurrent.futures.CancelledError:
+                return None
+
+
+class LevelMeter:
+    """Measures peak and RMS levels and counts clipped samples of each
+    track and of the master mix, in the audio callback.
+
+    Each mix slice copies the playing tracks' samples into rows of one
+    preallocated block, so every track is measured by a few vectorized
+    operations over the whole block. Levels add up in one of two sets of
+    accumulators while the other holds the last completed period of
+    1 / METER_HZ seconds. Only the audio callback swaps and clears the
+    sets, in 'flip', and it counts 'sequence' up around the swap, so
+    'read' can copy the completed set without a lock or waiting: it just
+    copies again if a swap came in between. Any number of readers get the
+    same set.
+
+    Rows are handed out to tracks by position, but each set remembers the
+    uid of the track in every row, and 'read' reports levels by uid.
+    """
+
+    PEAK, SQUARES, FRAMES, CLIPS = range(4)
+
+    def __init__(self, capacity=METER_TRACKS, block_frames=CHUNK,
+                 period_frames=RATE // METER_HZ):
+        self.capacity = capacity
+        self.block = np.zeros((capacity, block_frames), dtype=np.float32)
+        self.magnitudes = np.zeros_like(self.block)
+        self.indices = np.zeros(capacity, dtype=np.intp)  # Track of each row
+        # [set][track..., master][PEAK, SQUARES, FRAMES, CLIPS]
+        self.levels = np.zeros((2, capacity + 1, 4))
+        self.uids = [[None] * capacity, [None] * capacity]  # [set][row]
+        # Scratch for the master mix
+        self.master_magnitudes = np.zeros((block_frames, CHANNELS),
+                                          dtype=np.int32)
+        self.master_samples = np.zeros(block_frames * CHANNELS,
+                                       dtype=np.float32)
+        self.front = 0  # Set the audio callback adds to
+        self.period_frames = period_frames
+        self.frames = 0  # Frames since the last swap
+        self.sequence = 0  # Odd while the sets are being swapped
+        self.master_clips = 0  # Since 'reset_clips'
+
+    def flip(self, frames: int):
+        """Swaps the sets once a period is complete. Called by the audio
+        callback before it measures a block of 'frames'."""
+        self.frames += frames
+        if self.frames < self.period_frames:
+            return
+        self.frames = 0
+        self.sequence += 1
+        self.front = 1 - self.front
+        self.levels[self.front] = 0
+        self.sequence += 1
+
+    def assign(self, row: int, track_uid):
+        """Gives 'row' to the track with 'track_uid', dropping the levels
+        of another track that had it since the last read."""
+        uids = self.uids[self.front]
+        if uids[row] != track_uid:
+            uids[row] = track_uid
+            self.levels[self.front, row] = 0
+
+    def measure_tracks(self, rows: int, frames: int):
+        """Adds the first 'rows' rows of 'block' to their tracks' levels."""
+        if rows == 0:
+            return
+        levels = self.levels[self.front]
+        indices = self.indices[:rows]
+        block = self.block[:rows, :frames]
+        magnitudes = np.abs(block, out=self.magnitudes[:rows, :frames])
+        levels[indices, self.PEAK] = np.maximum(levels[indices, self.PEAK],
+                                                magnitudes.max(axis=1))
+        levels[indices, self.SQUARES] += np.einsum('ij,ij->i', block, block)
+        levels[indices, self.FRAMES] += frames
+        levels[indices, self.CLIPS] += np.count_nonzero(
+            magnitudes >= 32767, axis=1)
+
+    def measure_master(self, mix):
+        """Adds the mix (int32, before clipping) to the master levels."""
+        master = self.levels[self.front, -1]
+        frames = len(mix)
+        if frames <= len(self.master_magnitudes):
+            magnitudes = np.abs(mix, out=self.master_magnitudes[:frames])
+            samples = self.master_samples[:mix.size]
+            samples[:] = mix.ravel()
+        else:
+            magnitudes = np.abs(mix)
+            samples = mix.ravel().astype(np.float32)
+        master[self.PEAK] = max(master[self.PEAK], magnitudes.max())
+        master[self.SQUARES] += np.dot(samples, samples)
+        master[self.FRAMES] += len(samples)
+        clips = np.count_nonzero(magnitudes > 32767)
+        master[self.CLIPS] += clips
+        self.master_clips += clips
+
+    def read(self):
+        """Returns the levels of the last completed period as a dictionary
+        with the 'tracks' (track uid -> levels, for tracks that played),
+        the 'master', each a (peak, rms, clipped) tuple with levels in
+        dBFS, and the period's 'sequence' number. Never waits for the
+        audio callback."""
+        while True:
+            sequence = self.sequence
+            # Odd while the callback is swapping the sets
+            if sequence % 2 == 0:
+                back = 1 - self.front
+                levels = self.levels[back].copy()
+                uids = list(self.uids[back])
+                if self.sequence == sequence:
+                    break
+            time.sleep(0)  # Lets the callback finish the swap
+        return {
+            'tracks': {uid: self._summary(row)
+                       for uid, row in zip(uids, levels)
+                       if uid is not None and row[self.FRAMES]},
+            'master': self._summary(levels[-1]),
+            'sequence': sequence,
+        }
+
+    def reset_clips(self):
+        self.master_clips = 0
+
+    def _summary(self, row):
+        peak, squares, frames, clips = row
+        rms = math.sqrt(squares / frames) if frames else 0
+        return (self._dbfs(peak), self._dbfs(rms), bool(clips))
+
+    @staticmethod
+    def _dbfs(level):
+        return 20 * math.log10(level / 32768) if level > 0 else -math.inf
+
+
+class StateLog:
+    """Gives the loop's state a version number that goes up whenever it
+    changes, so any number of UI clients can tell whether they are out of
+    date and fetch only what changed.
+
+    'snapshot' compares the loop and track settings with the last
+    snapshot, so changes are picked up however they were made. Track
+    audio can change without its settings changing, so 'touch' is called
+    whenever a track's buffer is modified.
+    """
+
+    LOOP_FIELDS = ('uid', 'bpm', 'beats_per_loop', 'frames_per_loop',
+                   'latency_compensation_samples', 'is_playing', 'quantize',
+                   'scene_name')
+    TRACK_FIELDS = ('name', 'is_muted', 'is_recording', 'pitch_shift',
+                    'offset_beats', 'stretch_engine', 'original_bpm', 'bpm',
+                    'beats_per_loop')
+
+    def __init__(self, loop_machine):
+        self.loop_machine = loop_machine
+        self.version = 0
+        self._state = {'loop': {}, 'order': [], 'tracks': {}}
+        self._changes = deque(maxlen=STATE_HISTORY)  # (version, changed keys)
+        self._buffer_versions = {}  # Track uid -> times its buffer changed
+        self._lock = threading.Lock()
+
+    def touch(self, track):
+        """Notes that a track's audio changed."""
+        with self._lock:
+            uid = str(track.track_uid)
+            self._buffer_versions[uid] = self._buffer_versions.get(uid, 0) + 1
+
+    def snapshot(self):
+        """Returns the current version and state, as a dictionary of JSON
+        types with the 'loop' settings, the track 'order' (by uid) and the
+        'tracks' by uid."""
+        loop_machine = self.loop_machine
+        tracks = loop_machine.tracks
+        with self._lock:
+            state = {
+                'loop': {field: getattr(loop_machine, field)
+                         for field in self.LOOP_FIELDS},
+                'order': [str(track.track_uid) for track in tracks],
+                'tracks': {},
+            }
+            state['loop']['uid'] = str(state['loop']['uid'])
+            for track in tracks:
+                uid = str(track.track_uid)
+                fields = {field: getattr(track, field)
+                          for field in self.TRACK_FIELDS}
+                fields['buffer_version'] = self._buffer_versions.get(uid, 0)
+                state['tracks'][uid] = fields
+            previous = self._state
+            changed = {('loop', field) for field in self.LOOP_FIELDS
+                       if state['loop'][field] != previous['loop'].get(field)}
+            for uid in state['tracks'].keys() | previous['tracks']:
+                fields = state['tracks'].get(uid) or {}
+                previous_fields = previous['tracks'].get(uid) or {}
+                if fields != previous_fields:
+                    changed.add(('track', uid))
+                    changed |= {('field', uid, field)
+                                for field in fields.keys() | previous_fields
+                                if fields.get(field)
+                                != previous_fields.get(field)}
+            if state['order'] != previous['order']:
+                changed.add(('order',))
+            if changed:
+                self.version += 1
+                self._changes.append((self.version, changed))
+                self._state = state
+            return self.version, self._state
+
+    def changes_since(self, version: int):
+        """Returns the current version and what changed since 'version':
+        changed 'loop' settings, changed or added 'tracks' by uid, the
+        names of their changed 'fields' by uid, the uids of 'removed'
+        tracks and, if it changed, the track 'order'.
+        Returns the whole state with 'full' set if 'version' is too old to
+        diff against."""
+        current, state = self.snapshot()
+        with self._lock:
+            changes = list(self._changes)
+        if version > current or (
+                version < current
+                and (not changes or changes[0][0] > version + 1)):
+            return current, dict(state, full=True)
+        changed = set()
+        for change_version, keys in changes:
+            if change_version > version:
+                changed |= keys
+        diff = {'loop': {key[1]: state['loop'][key[1]]
+                         for key in changed if key[0] == 'loop'},
+                'tracks': {}, 'fields': {}, 'removed': []}
+        for key in changed:
+            if key[0] == 'track':
+                if key[1] in state['tracks']:
+                    diff['tracks'][key[1]] = state['tracks'][key[1]]
+                else:
+                    diff['removed'].append(key[1])
+            elif key[0] == 'field' and key[1] in state['tracks']:
+                diff['fields'].setdefault(key[1], []).append(key[2])
+        for fields in diff['fields'].values():
+            fields.sort()
+        if ('order',) in changed:
+            diff['order'] = state['order']
+        return current, diff
+
+
+class EventScheduler:
+    """Runs actions in the audio callback at the exact sample of the next
+    beat, bar or loop boundary.
+
+    Control threads queue events; the audio thread moves them into a heap
+    ordered by the sample they are due at, so neither side takes a lock
+    and each event costs O(log n). While the transport is paused no
+    boundary comes, so the callback runs pending events right away, see
+    'drain'.
+    """
+
+    def __init__(self):
+        self.clock = 0  # Samples played since the stream started
+        self._heap = []  # (sample, order, action)
+        self._incoming = deque()  # (quantize, order, action)
+        self._order = itertools.count()  # Keeps events at one sample in order
+        self._cleared_before = 0  # Events added before this order are dropped
+        self._heap_cleared_before = 0  # '_cleared_before' applied to the heap
+
+    def add(self, quantize: str, action):
+        """Runs 'action' (a callable taking no arguments) in the audio
+        thread at the next 'quantize' boundary: "beat", "bar" or "loop".
+        It must be quick, e.g. setting attributes."""
+        self._incoming.append((quantize, next(self._order), action))
+
+    def clear(self):
+        """Drops every event added so far, e.g. edits of a loop that was
+        replaced. Events added after it are kept."""
+        self._cleared_before = next(self._order)
+
+    def __len__(self):
+        return len(self._heap) + len(self._incoming)
+
+    def due(self, frames: int, position: int, samples_per_beat: float,
+            frames_per_loop: int):
+        """Returns (offset, action) for the events due in the block of
+        'frames' starting at loop 'position', in order, and moves the clock
+        past the block. Called by the audio thread only."""
+        cleared_before = self._cleared_before
+        if cleared_before != self._heap_cleared_before:
+            self._heap_cleared_before = cleared_before
+            self._heap = [event for event in self._heap
+                          if event[1] >= cleared_before]
+            heapq.heapify(self._heap)
+        while self._incoming:
+            quantize, order, action = self._incoming.popleft()
+            if order < cleared_before:
+                continue
+            delay = self._delay(quantize, frames, position, samples_per_beat,
+                                frames_per_loop)
+            heapq.heappush(self._heap, (self.clock + delay, order, action))
+        end = self.clock + frames
+        events = []
+        while self._heap and self._heap[0][0] < end:
+            sample, _, action = heapq.heappop(self._heap)
+            events.append((max(sample - self.clock, 0), action))
+        self.clock = end
+        return events
+
+    def drain(self):
+        """Returns the actions of all pending events in order and drops
+        them. Called by the audio thread only, while paused."""
+        cleared_before = self._cleared_before
+        events = [(order, action) for _, order, action in self._heap
+                  if order >= cleared_before]
+        self._heap.clear()
+        while self._incoming:
+            _, order, action = self._incoming.popleft()
+            if order >= cleared_before:
+                events.append((order, action))
+        events.sort(key=lambda event: event[0])
+        return [action for _, action in events]
+
+    @staticmethod
+    def _delay(quantize, frames, position, samples_per_beat,
+               frames_per_loop):
+        """Returns the samples from 'position' to the next boundary."""
+        if quantize != "loop":
+            step = BEATS_PER_BAR if quantize == "bar" else 1
+            beat = math.ceil(position / samples_per_beat / step) * step
+            # Found like the metronome's clicks
+            onset = int(beat * samples_per_beat)
+            if onset < frames_per_loop:
+                return onset - position
+        # The loop restarts at the end of the block that reaches its end
+        return math.ceil((frames_per_loop - position) / frames) * frames
+
+
+class DeferredWork:
+    """Runs work handed off by the audio callback, such as starting renders
+    and notifying handlers, in order on a thread of its own, so the
+    callback itself only swaps references.
+
+    'put' only appends to a queue, so the callback never waits on it.
+    """
+
+    def __init__(self):
+        self._queue = queue.SimpleQueue()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def put(self, action, *args):
+        """Runs 'action(*args)' on the worker thread."""
+        self._queue.put((action, args))
+
+    def stop(self):
+        self._queue.put(None)
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            action, args = job
+            try:
+                action(*args)
+            except Exception as error:
+                print(f"Background work failed: {error!r}")
+
+
+class TrackStorage:
+    """Backs raw track buffers with memory-mapped .npy files in a session
+    directory, so the OS pages cold audio out instead of it filling RAM.
+
+    Tracks are handed to 'store' whenever a buffer changes; a background
+    thread writes each new raw buffer to its own file and swaps in the
+    mapped copy. Files are never rewritten, since playback may be reading
+    them. Rendered buffers stay in RAM: they are read every loop, so
+    mapping them would page nothing out, and each render would leave a
+    file behind. Recording and overdubs write into buffers in RAM, so the
+    audio thread never page-faults on a file.
+
+    The same files make up the saved session, see 'LoopMachine.save'.
+    'map' and 'prune' take 'lock', so a save never names a file that
+    was just pruned.
+    """
+
+    SESSION_FILE = 'session.pkl'
+
+    def __init__(self, session_dir: str):
+        self.session_dir = session_dir
+        os.makedirs(session_dir, exist_ok=True)
+        self.lock = threading.RLock()
+        self._queue = queue.SimpleQueue()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    @staticmethod
+    def is_mapped(array):
+        """Returns True if 'array' is backed by a file. Copies of mapped
+        arrays are still np.memmap instances, but live in RAM."""
+        return isinstance(array, np.memmap) and array.filename is not None
+
+    def store(self, track):
+        """Queues a track whose buffers may not be mapped yet."""
+        self._queue.put(track)
+
+    def map(self, track):
+        """Moves the track's raw buffer into a file, unless it is
+        recording."""
+        with self.lock:
+            if track.is_recording:
+                return
+            raw_buffer = track.raw_buffer
+            if raw_buffer is not None and not self.is_mapped(raw_buffer):
+                mapped = self._write(track, 'raw', raw_buffer)
+                if track.buffer is raw_buffer:
+                    track.buffer = mapped
+                # Unless an overdub has replaced it meanwhile
+                if track.raw_buffer is raw_buffer:
+                    track.raw_buffer = mapped
+
+    def prune(self, tracks):
+        """Deletes the buffer files no longer used by 'tracks'."""
+        with self.lock:
+            used = {os.path.abspath(array.filename) for track in tracks
+                    for array in (track.raw_buffer, track.buffer)
+                    if self.is_mapped(array)}
+            for name in os.listdir(self.session_dir):
+                path = os.path.abspath(os.path.join(self.session_dir, name))
+                if name.endswith('.npy') and path not in used:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass  # Still mapped by the app on Windows
+
+    def stop(self):
+        """Stops the background thread once the tracks queued are mapped."""
+        self._queue.put(None)
+
+    def _write(self, track, kind, array):
+        """Copies 'array' into a new file and returns it mapped."""
+        path = os.path.join(
+            self.session_dir,
+            f'{track.track_uid}-{kind}-{uuid.uuid4().hex[:8]}.npy')
+        mapped = np.lib.format.open_memmap(
+            path, mode='w+', dtype=array.dtype, shape=array.shape)
+        mapped[:] = array
+        return mapped
+
+    def _run(self):
+        while True:
+            track = self._queue.get()
+            if track is None:
+                return
+            self.map(track)
+
+
+class Journal:
+    """Autosaves the loop incrementally to an append-only journal.
+
+    Every AUTOSAVE_SECONDS a background thread compares the loop with what
+    it last wrote and appends only the differences: changed loop and
+    track settings, the track order, and the raw buffers of tracks that
+    are new or were recorded into. Once the journal passes
+    AUTOSAVE_COMPACT_BYTES (or another loop is loaded) it is folded into
+    a full snapshot and started afresh. 'recover' replays the snapshot and
+    journal after a crash.
+
+    Records are pickled, each preceded by its length and CRC, so a record
+    cut short by a crash is detected and ignored.
+    """
+
+    SNAPSHOT_FILE = 'snapshot.pkl'
+    JOURNAL_FILE = 'journal.log'
+    CLEAN_FILE = 'clean'  # Written on a clean stop
+    LOOP_FIELDS = ('bpm', 'beats_per_loop', 'latency_compensation_samples')
+    TRACK_FIELDS = ('name', 'is_muted', 'offset_beats', 'pitch_shift',
+                    'original_bpm', 'bpm', 'frames_per_loop',
+                    'stretch_engine', 'beats_per_loop', 'start_beat')
+    HEADER = struct.Struct('<II')  # Record length, CRC-32
+
+    def __init__(self, loop_machine, directory=AUTOSAVE_DIR):
+        self.loop_machine = loop_machine
+        self.directory = directory
+        self.dirty = set()  # Track uids whose raw buffer changed in place
+        self._written = None  # State as of the last record written
+        self._file = None
+        self._is_running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._thread.start()
+
+    def mark_dirty(self, track):
+        """Notes that a track's raw buffer has new audio."""
+        self.dirty.add(track.track_uid)
+
+    def stop(self):
+        """Writes the last changes and marks the autosave as clean."""
+        if not self._is_running:
+            return
+        self._is_running = False
+        if self._thread.is_alive():
+            self._thread.join()
+        self.write()
+        if self._file:
+            self._file.close()
+        open(os.path.join(self.directory, self.CLEAN_FILE), 'w').close()
+
+    def _run(self):
+        while self._is_running:
+            time.sleep(AUTOSAVE_SECONDS)
+            self.write()
+
+    def write(self):
+        """Appends what changed since the last write, compacting first if
+        the journal is too long or another loop was loaded."""
+        loop_machine = self.loop_machine
+        uid = loop_machine.uid
+        if (self._written is None or self._written['uid'] != uid
+                or self._file.tell() > AUTOSAVE_COMPACT_BYTES):
+            self._compact()
+            return
+        tracks = [track for track in loop_machine.tracks
+                  if not track.is_recording]
+        written = self._written
+        records = []
+        loop = {field: getattr(loop_machine, field)
+                for field in self.LOOP_FIELDS}
+        if loop != written['loop']:
+            records.append(('loop', loop))
+        dirty, self.dirty = self.dirty, set()
+        for track in tracks:
+            fields = {field: getattr(track, field)
+                      for field in self.TRACK_FIELDS}
+            uid = track.track_uid
+            raw_buffer = track.raw_buffer
+            if raw_buffer is not None and (
+                    uid not in written['raw'] or uid in dirty
+                    or written['raw'][uid]() is not raw_buffer):
+                records.append(('raw', uid, np.array(raw_buffer)))
+                written['raw'][uid] = weakref.ref(raw_buffer)
+            if fields != written['tracks'].get(uid):
+                records.append(('track', uid, fields))
+                written['tracks'][uid] = fields
+        order = [track.track_uid for track in tracks]
+        if order != written['order']:
+            records.append(('order', order))
+        written['loop'], written['order'] = loop, order
+        # Imported on first use to keep the app's start-up fast
+        import dill
+
+        for record in records:
+            data = dill.dumps(record)
+            self._file.write(self.HEADER.pack(len(data), zlib.crc32(data)))
+            self._file.write(data)
+        if records:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def _compact(self):
+        """Writes a full snapshot and starts an empty journal."""
+        loop_machine = self.loop_machine
+        tracks = [track for track in loop_machine.tracks
+                  if not track.is_recording]
+        path = os.path.join(self.directory, self.SNAPSHOT_FILE)
+        with open(f'{path}.tmp', 'wb') as file:
+            SessionPickler(file).dump(loop_machine)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(f'{path}.tmp', path)
+        if self._file:
+            self._file.close()
+        self._file = open(
+            os.path.join(self.directory, self.JOURNAL_FILE), 'wb')
+        clean = os.path.join(self.directory, self.CLEAN_FILE)
+        if os.path.exists(clean):
+            os.remove(clean)
+        self.dirty.clear()
+        self._written = {
+            'uid': loop_machine.uid,
+            'loop': {field: getattr(loop_machine, field)
+                     for field in self.LOOP_FIELDS},
+            'order': [track.track_uid for track in tracks],
+            'tracks': {track.track_uid: {field: getattr(track, field)
+                                         for field in self.TRACK_FIELDS}
+                       for track in tracks},
+            'raw': {track.track_uid: weakref.ref(track.raw_buffer)
+                    for track in tracks if track.raw_buffer is not None},
+        }
+
+    @classmethod
+    def needs_recovery(cls, directory=AUTOSAVE_DIR):
+        """Returns True if the last run stopped without a clean stop."""
+        return (os.path.exists(os.path.join(directory, cls.SNAPSHOT_FILE))
+                and not os.path.exists(os.path.join(directory,
+                                                    cls.CLEAN_FILE)))
+
+    @classmethod
+    def recover(cls, directory=AUTOSAVE_DIR):
+        """Returns the autosaved 'LoopMachine' (without a stream), rebuilt
+        from the snapshot and the journal."""
+        import dill
+
+        with open(os.path.join(directory, cls.SNAPSHOT_FILE), 'rb') as file:
+            loop = SessionUnpickler(file).load()
+        tracks = {track.track_uid: track for track in loop.tracks}
+        order = list(tracks)
+        try:
+            with open(os.path.join(directory, cls.JOURNAL_FILE), 'rb') as file:
+                journal = file.read()
+        except FileNotFoundError:
+            journal = b''
+        offset = 0
+        while offset + cls.HEADER.size <= len(journal):
+            length, crc = cls.HEADER.unpack_from(journal, offset)
+            data = journal[offset + cls.HEADER.size:
+                           offset + cls.HEADER.size + length]
+            if len(data) < length or zlib.crc32(data) != crc:
+                break  # Cut short by the crash
+            offset += cls.HEADER.size + length
+            record = dill.loads(data)
+            if record[0] == 'loop':
+                loop.__dict__.update(record[1])
+            elif record[0] == 'order':
+                order = record[1]
+            else:
+                _, uid, value = record
+                if uid not in tracks:
+                    tracks[uid] = Track(0, loop.bpm)
+                    tracks[uid].track_uid = uid
+                track = tracks[uid]
+                if record[0] == 'raw':
+                    track.raw_buffer = track.buffer = value
+                else:
+                    track.__dict__.update(value)
+        loop.tracks = tuple(tracks[uid] for uid in order if uid in tracks)
+        loop.frames_per_loop = int(
+            (60 / loop.bpm) * loop.beats_per_loop * RATE)
+        return loop
+
+
+class SessionPickler(pickle.Pickler):
+    """Pickles memory-mapped buffers as references to their files.
+
+    The standard library's pickler is enough for loops and needs no dill
+    at start-up; 'SessionUnpickler' still reads files that refer to dill,
+    importing it then.
+    """
+
+    def persistent_id(self, obj):
+        if TrackStorage.is_mapped(obj):
+            return ('memmap', os.path.abspath(obj.filename))
+        return None
+
+
+class SessionUnpickler(pickle.Unpickler):
+    """Maps the buffer files referenced by a 'SessionPickler'."""
+
+    def persistent_load(self, pid):
+        kind, path = pid
+        return np.load(path, mmap_mode='r+')
+
+
+class TrackPool:
+    """Keeps a few empty tracks of the current loop length ready, so
+    starting a recording in the audio callback doesn't allocate.
+
+    A background thread builds the tracks, touching every page of their
+    buffers so the audio thread never page-faults on them, and rebuilds
+    them when the loop length changes. The thread only adds tracks: the
+    audio thread moves those of an old length to 'stale', see 'sweep',
+    and the thread frees them.
+    """
+
+    def __init__(self, loop_machine, size=TRACK_POOL_SIZE):
+        self.loop_machine = loop_machine
+        self.size = size
+        self.ready = deque()  # Tracks ready to record into
+        self.stale = deque()  # Tracks of an old length, to free
+        self._swept_frames = None  # Loop length of the last 'sweep'
+        self._wake = threading.Event()
+        self._is_running = True
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def take(self, frames_per_loop: int, bpm: float):
+        """Returns an empty track for recording at 'bpm'. Only builds one
+        here if none of the right length is ready.
+
+        Everything that depends on the tempo is set here, so a pooled
+        track is right whatever tempo it was built at."""
+        track = None
+        while self.ready:
+            candidate = self.ready.popleft()
+            if len(candidate.raw_buffer) == frames_per_loop:
+                track = candidate
+                break
+            self.stale.append(candidate)
+        self._wake.set()
+        if track is None:
+            return Track(frames_per_loop, bpm)
+        track.original_bpm = track.bpm = bpm
+        track.beats_per_loop = max(
+            1, round(frames_per_loop / ((60 / bpm) * RATE)))
+        return track
+
+    def sweep(self, frames_per_loop: int):
+        """Moves tracks of an old length to 'stale' so they are freed.
+        Called by the audio thread, at the end of a loop, since only that
+        thread removes tracks."""
+        if frames_per_loop == self._swept_frames:
+            return
+        self._swept_frames = frames_per_loop
+        for _ in range(len(self.ready)):
+            track = self.ready.popleft()
+            if len(track.raw_buffer) == frames_per_loop:
+                self.ready.append(track)
+            else:
+                self.stale.append(track)
+
+    def refill(self):
+        """Asks for the pool to be checked, e.g. after the loop length
+        changed."""
+        self._wake.set()
+
+    def stop(self):
+        self._is_running = False
+        self._wake.set()
+
+    def _run(self):
+        """Keeps 'size' tracks of the current loop length ready."""
+        while self._is_running:
+            self._wake.clear()
+            self.stale.clear()
+            loop_machine = self.loop_machine
+            # Both from the same loop, even if a scene is swapped in
+            # between. 'take' resets the tempo fields, so a tempo change
+            # between the two reads does no harm
+            state = loop_machine.__dict__
+            frames_per_loop, bpm = state['frames_per_loop'], state['bpm']
+            # Only the audio thread removes tracks, see 'take' and 'sweep',
+            # so it always finds the ready ones.
+            # 'copy' runs without releasing the GIL, so it can't see the
+            # deque change under it
+            ready = sum(len(track.raw_buffer) == frames_per_loop
+                        for track in self.ready.copy())
+            while ready < self.size:
+                track = Track(frames_per_loop, bpm)
+                # Shared memory is mapped lazily; write the pages now
+                track.raw_buffer.fill(0)
+                self.ready.append(track)
+                ready += 1
+            self._wake.wait(TRACK_POOL_CHECK_SECONDS)
+
+
+class EditHistory:
+    """Undo and redo stacks of track edits.
+
+    An entry is ('params', [(track, {field: (old, new)})]) or
+    ('remove', [(index, track)]). Entries keep references to the tracks
+    they change, so the history itself holds no audio copies. Overdubs
+    sum into a copy of the raw buffer (see 'LoopMachine.start_overdub'),
+    so a raw buffer never changes once a track stops recording. Once
+    removed tracks hold more than 'max_bytes', the oldest ones' raw
+    buffers are written to a directory of this process in HISTORY_DIR
+    until an undo brings them back. The directory is removed when the
+    loop machine stops or the process exits, see 'remove_spills'.
+    """
+
+    SPILL_DIR = os.path.join(HISTORY_DIR, str(uuid.uuid4()))
+    _removes_at_exit = False
+
+    def __init__(self, max_bytes=HISTORY_BYTES, max_entries=HISTORY_LENGTH):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.undo_stack = []
+        self.redo_stack = []
+        self.spilled = {}  # Track -> path of its raw buffer on disk
+        self.spill_dir = self.SPILL_DIR
+        self._lock = threading.Lock()
+
+    def record(self, entry, live_tracks):
+        """Adds an edit, which can no longer be redone past."""
+        with self._lock:
+            self.undo_stack.append(entry)
+            for dropped in self.redo_stack:
+                self._discard(dropped, live_tracks)
+            self.redo_stack.clear()
+            while len(self.undo_stack) > self.max_entries:
+                self._discard(self.undo_stack.pop(0), live_tracks)
+            self._spill(live_tracks)
+
+    def pop(self, redo=False):
+        """Takes the next entry to undo (or redo), or None."""
+        with self._lock:
+            stack = self.redo_stack if redo else self.undo_stack
+            return stack.pop() if stack else None
+
+    def push(self, entry, redo=False, live_tracks=()):
+        """Puts an entry that was just undone (or redone) on the other
+        stack."""
+        with self._lock:
+            (self.undo_stack if redo else self.redo_stack).append(entry)
+            self._spill(live_tracks)
+
+    def restore(self, track):
+        """Reads a spilled track's raw buffer back from disk. Returns True
+        if it had been spilled, and so needs rendering again."""
+        with self._lock:
+            path = self.spilled.pop(track, None)
+        if not path:
+            return False
+        track.raw_buffer = track.buffer = np.load(path)
+        os.remove(path)
+        return True
+
+    def nbytes(self, live_tracks=()):
+        """Returns the bytes held only by the history."""
+        with self._lock:
+            return sum(size for _, size in self._held(live_tracks))
+
+    def _held(self, live_tracks):
+        """Yields (track, bytes) for removed tracks in memory, oldest edit
+        first. Arrays shared with live tracks are not counted."""
+        seen = set()
+        for track in live_tracks:
+            track.memory_usage(seen)
+        for kind, changes in self.undo_stack + self.redo_stack:
+            if kind != 'remove':
+                continue
+            for _, track in changes:
+                if track in self.spilled or track in live_tracks:
+                    continue
+                yield track, sum(track.memory_usage(seen).values())
+
+    def _spill(self, live_tracks):
+        """Writes removed tracks to disk, oldest first, until the rest fit
+        in 'max_bytes'."""
+        held = list(self._held(live_tracks))
+        total = sum(size for _, size in held)
+        for track, size in held:
+            if total <= self.max_bytes:
+                return
+            if size == 0:
+                continue
+            os.makedirs(self.spill_dir, exist_ok=True)
+            if not EditHistory._removes_at_exit:
+                EditHistory._removes_at_exit = True
+                atexit.register(EditHistory.remove_spills)
+            path = os.path.join(self.spill_dir, f'{track.track_uid}.npy')
+            np.save(path, track.raw_buffer)
+            # Re-rendered if the track is restored
+            track.raw_buffer = track.buffer = None
+            self.spilled[track] = path
+            total -= size
+
+    @classmethod
+    def remove_spills(cls):
+        """Deletes the spill files of every history in this process.
+        Their tracks can't be undone back afterwards."""
+        shutil.rmtree(cls.SPILL_DIR, ignore_errors=True)
+
+    def _discard(self, entry, live_tracks):
+        """Deletes the spill files of an entry that is dropped."""
+        kind, changes = entry
+        if kind != 'remove':
+            return
+        for _, track in changes:
+            if track not in live_tracks and track in self.spilled:
+                os.remove(self.spilled.pop(track))
+
+
+class SceneBank:
+    """Keeps whole loops ("scenes") deserialized and rendered in memory, so
+    the loop machine can switch to one at a loop boundary without loading
+    it from disk.
+
+    Scenes are kept as 'LoopMachine' objects without a stream. When they
+    take more than 'max_bytes', the least recently used ones are written to
+    'loops/scenes' and loaded again when they are next needed.
+    """
+
+    def __init__(self, max_bytes=SCENE_BANK_BYTES):
+        self.max_bytes = max_bytes
+        self.scenes = OrderedDict()  # Name -> [filename, scene or None]
+        self._lock = threading.Lock()
+
+    def add(self, name, filename):
+        """Loads the saved loop 'filename' from 'loops' as scene 'name'.
+        Returns False if the file was not found."""
+        try:
+            with open(os.path.join('loops', filename), 'rb') as file:
+                scene = blob_store.BlobUnpickler(file).load()
+        except FileNotFoundError:
+            print(f'{filename} was not found.')
+            return False
+        for track in scene.tracks:
+            track.load_render()
+        self.store(name, scene, filename)
+        return True
+
+    def store(self, name, scene, filename=None):
+        """Keeps 'scene' in memory as 'name'. Without a 'filename' it is
+        written to disk before being evicted."""
+        with self._lock:
+            self.scenes[name] = [filename, scene]
+            self.scenes.move_to_end(name)
+            self._evict()
+
+    def take(self, name):
+        """Removes scene 'name' from the bank and returns it, loading it
+        from disk if it was evicted. Returns None for unknown scenes."""
+        with self._lock:
+            entry = self.scenes.pop(name, None)
+        if entry is None:
+            return None
+        filename, scene = entry
+        if scene is None:
+            with open(os.path.join('loops', filename), 'rb') as file:
+                scene = blob_store.BlobUnpickler(file).load()
+        return scene
+
+    def names(self):
+        """Returns the names of the scenes, most recently used last."""
+        with self._lock:
+            return list(self.scenes)
+
+    def nbytes(self):
+        """Returns the bytes held by the scenes in memory."""
+        with self._lock:
+            return self._nbytes()
+
+    def _nbytes(self):
+        seen = set()
+        return sum(sum(track.memory_usage(seen).values())
+                   for _, scene in self.scenes.values() if scene
+                   for track in scene.tracks)
+
+    def _evict(self):
+        """Writes the least recently used scenes to disk until the rest
+        fit in 'max_bytes'. The most recent scene always stays."""
+        for name, entry in self.scenes.items():
+            if self._nbytes() <= self.max_bytes:
+                return
+            if name == next(reversed(self.scenes)):
+                return
+            filename, scene = entry
+            if scene is None:
+                continue
+            if filename is None:
+                # Scenes played live since loading may have changed
+                filename = os.path.join('scenes', f'{scene.uid}.pkl')
+                os.makedirs(os.path.join('loops', 'scenes'), exist_ok=True)
+                with open(os.path.join('loops', filename), 'wb') as file:
+                    blob_store.BlobPickler(file).dump(scene)
+            entry[:] = [filename, None]
+
+
 class LoopMachine:
     def __init__(self, bpm: int, beats_per_loop: int):
         # Allocate memory for multiple loop layers
@@ -142,15 +1371,44 @@ class LoopMachine:
         self.frames_per_loop = int(
             (60 / self.bpm) * self.beats_per_loop * RATE)  # Loop length in frames
         self.current_track = None  # Active buffer being recorded
-        self.tracks = []  # List of recorded tracks
+        self.is_overdubbing = False  # Summing into 'current_track' if True
+        self.overdub_track = None  # Track to overdub on reaching checkpoint
+        # Recorded tracks. Never changed in place: edits publish a new
+        # tuple, so the audio thread always mixes one consistent snapshot.
+        # Only '_update_tracks' publishes it, see there
+        self.tracks = ()
+        self.recorded = deque()  # Tracks the callback started, until merged
+        self.tracks_lock = threading.Lock()  # Held by '_update_tracks'
         self.position = 0  # Playback and recording position
+        # Beats played before this loop started, which places tracks of
+        # other lengths, see '_track_start'
+        self.loop_start_beat = 0
         self.checkpoint_position = 0
         self.checkpoint_action = None  # Action to perform on reaching checkpoint
-        self.click_track = generate_clicks(self.bpm, self.beats_per_loop)
+        self.metronome = Metronome()
         self.click_is_muted = True
         self.uid = uuid.uuid4()
         self.is_playing = True
-        self.latency_compensation_samples = 8000
+        self.latency_compensation_samples = LATENCY_COMPENSATION_SAMPLES
+        self.bounce_history = []  # Undo files of bounces, most recent last
+        self.target_bpm = bpm  # Most recently requested BPM
+        self.render_batch_id = None  # Identifies the running tempo render
+        self.render_progress = None  # (done, total) while it runs
+        # (bpm, buffers) to publish at the next loop boundary
+        self.pending_tempo = None
+        self.speculative = SpeculativeRenderer(self)
+        self.track_pool = TrackPool(self)
+        self.scheduler = EventScheduler()
+        self.deferred = DeferredWork()  # Work handed off by the callback
+        self.meter = LevelMeter()
+        self.state_log = StateLog(self)
+        self.storage = None  # 'TrackStorage' if buffers are memory-mapped
+        self.journal = None  # 'Journal' once autosave is started
+        self.quantize = None  # One of QUANTIZE_OPTIONS for track edits
+        self.history = EditHistory()
+        self.scenes = SceneBank()
+        self.scene_name = None  # Name of the scene playing, if any
+        self.pending_scene = None  # (name, scene) to switch to at the boundary
         # A callable handler which receives a single paramter of type 'Track'
         self.on_track_buffer_modified = None
 
@@ -177,19 +1435,55 @@ class LoopMachine:
         self._set_checkpoint_now()
         self.checkpoint_action = "STOP"
 
+    def start_overdub(self, track_index: int):
+        """Start summing the input into an existing track.
+
+        Only tracks recorded at the current tempo can be overdubbed, since
+        their raw buffer lines up with playback.
+        """
+        track = self.tracks[track_index]
+        if (track.original_bpm != self.bpm
+                or len(track.raw_buffer) != int(
+                    (60 / self.bpm) * track.beats_per_loop * RATE)):
+            print("Overdub needs a track recorded at the current BPM.")
+            return False
+        # Overdub into a copy: the raw buffer may be shared with
+        # duplicates, the edit history, scenes and cached renders
+        raw_buffer = effects.shared_zeros(track.raw_buffer.shape,
+                                          track.raw_buffer.dtype)
+        raw_buffer[:] = track.raw_buffer
+        if track.buffer is track.raw_buffer:
+            track.buffer = raw_buffer
+        track.raw_buffer = raw_buffer
+        print("Overdub started...")
+        self._set_checkpoint_now()
+        self.checkpoint_action = "OVERDUB"
+        self.overdub_track = track
+        return True
+
     def _set_checkpoint_now(self):
         self.checkpoint_position = (
             self.position + self.latency_compensation_samples) % self.frames_per_loop
 
     def _on_track_buffer_modified(self, track):
+        if track is not None:
+            self.state_log.touch(track)
+        if self.storage and track is not None:
+            self.storage.store(track)
         if self.on_track_buffer_modified:
             self.on_track_buffer_modified(track)
 
     def audio_callback(self, indata, outdata, frames, time, status):
         """Handles real-time recording and playback with latency compensation."""
-        global_audio_out = np.zeros((frames, 1), dtype=np.int16)
+        # Mixed at int32 so the master meter sees what gets clipped
+        global_audio_out = np.zeros((frames, 1), dtype=np.int32)
+        tracks = self.tracks
+        self.meter.flip(frames)
         # If paused, return nothing
         if not self.is_playing:
+            # No boundary comes while paused, so quantized edits apply now
+            for action in self.scheduler.drain():
+                action()
             outdata[:] = global_audio_out
             return
         # Handle checkpoint
@@ -201,55 +1495,69 @@ class LoopMachine:
             checkpoint_reached = (self.checkpoint_position >=
                                   start or self.checkpoint_position < end)
         if checkpoint_reached:
-            if self.checkpoint_action in ("STOP", "NEW"):
+            if self.checkpoint_action in ("STOP", "NEW", "OVERDUB"):
                 if self.current_track:
                     self.current_track.is_recording = False
+                    self.deferred.put(self._finish_recording,
+                                      self.current_track, self.is_overdubbing)
+                    self.is_overdubbing = False
                     self.current_track = None
             if self.checkpoint_action == "NEW":
-                new_track = Track(self.frames_per_loop, self.bpm)
+                new_track = self.track_pool.take(self.frames_per_loop,
+                                                 self.bpm)
                 new_track.is_recording = True
+                new_track.start_beat = self.loop_start_beat
                 new_track._on_buffer_modified = self._on_track_buffer_modified
                 self.current_track = new_track
-                self.tracks.append(new_track)
+                # Merged into 'tracks' by a control thread, which can't
+                # then overwrite it with a table that misses it
+                self.recorded.append(new_track)
+                self.deferred.put(self._update_tracks)
+            elif self.checkpoint_action == "OVERDUB" and self.overdub_track:
+                # The track keeps playing while the input is summed into it
+                self.current_track = self.overdub_track
+                self.is_overdubbing = True
+            self.overdub_track = None
             self.checkpoint_action = None
 
         # Record audio if recording is active
         if self.current_track:
-            start_idx = self.position
-            end_idx = self.position + frames
-            if end_idx > self.frames_per_loop:
+            # New tracks start at this loop, so this is the loop position;
+            # overdubbed ones may be longer or shorter than the loop
+            raw_length = len(self.current_track.raw_buffer)
+            start_idx = (self._track_start(self.current_track, raw_length)
+                         + self.position) % raw_length
+            end_idx = start_idx + frames
+            if end_idx > raw_length:
                 # Calculate how many samples can be written before reaching the end.
-                samples_until_end = self.frames_per_loop - start_idx
+                samples_until_end = raw_length - start_idx
                 # Write the first part into the end of the buffer.
-                self.current_track.raw_buffer[start_idx:] = indata[:samples_until_end]
+                self._write_input(slice(start_idx, None),
+                                  indata[:samples_until_end])
                 # Write the remaining samples at the beginning of the buffer.
-                remaining_samples = frames - samples_until_end
-                self.current_track.raw_buffer[:remaining_samples] = indata[samples_until_end:]
+                remaining_samples = min(frames - samples_until_end,
+                                        raw_length)
+                self._write_input(
+                    slice(None, remaining_samples),
+                    indata[samples_until_end:samples_until_end
+                           + remaining_samples])
             else:
-                self.current_track.raw_buffer[start_idx:end_idx] = indata
+                self._write_input(slice(start_idx, end_idx), indata)
 
-        # Inject click track
-        if not self.click_is_muted:
-            click_position = self.position % len(self.click_track)
-            click_segment = self.click_track[click_position:click_position + frames]
-            if click_segment.shape[0] < frames:
-                padding = np.zeros(
-                    (frames - click_segment.shape[0], 1), dtype=np.int16)
-                click_segment = np.vstack((click_segment, padding))
-            global_audio_out += click_segment
-
-        # Inject tracks
-        for track in self.tracks:
-            if not track.is_muted and not track.is_recording:
-                playback_start = (
-                    self.position + self.latency_compensation_samples) % self.frames_per_loop
-                loop_segment = track.buffer[playback_start:playback_start + frames]
-                if loop_segment.shape[0] < frames:
-                    padding = np.zeros(
-                        (frames - loop_segment.shape[0], 1), dtype=np.int16)
-                    loop_segment = np.vstack((loop_segment, padding))
-                global_audio_out += loop_segment
+        # Mix the block, stopping at each scheduled event to run it at
+        # its exact sample
+        offset = 0
+        for event_offset, action in self.scheduler.due(
+                frames, self.position, (60 / self.bpm) * RATE,
+                self.frames_per_loop):
+            self._mix(global_audio_out[offset:event_offset],
+                      self.position + offset, tracks)
+            action()
+            tracks = self.tracks
+            offset = event_offset
+        self._mix(global_audio_out[offset:], self.position + offset, tracks)
 
+        self.meter.measure_master(global_audio_out)
         # Prevent clipping
         global_audio_out = np.clip(global_audio_out, -32768, 32767)
         outdata[:] = global_audio_out
@@ -257,51 +1565,768 @@ class LoopMachine:
         # Move position forward
         self.position += frames
         if self.position >= self.frames_per_loop:
+            # Normally 'beats_per_loop', unless it was made shorter than
+            # the part already played
+            self.loop_start_beat += round(
+                self.position / ((60 / self.bpm) * RATE))
             self.position = 0
+            self.track_pool.sweep(self.frames_per_loop)
+            if self.pending_scene:
+                self._publish_scene()
+            elif self.pending_tempo:
+                self._publish_tempo()
+
+    def _finish_recording(self, track, overdubbed: bool):
+        """Handles a track whose recording or overdub just ended, off the
+        audio thread."""
+        # Its raw audio changed since a save may have hashed it
+        blob_store.forget(track.raw_buffer)
+        if overdubbed:
+            # Raw audio changed, so the effects need re-rendering
+            track.apply_effects_async()
+            if self.journal:
+                self.journal.mark_dirty(track)
+        else:
+            self._on_track_buffer_modified(track)
+
+    def _mix(self, out, position: int, tracks):
+        """Adds the click and the playing tracks for the part of the block
+        starting at loop 'position' into 'out'."""
+        frames = len(out)
+        if frames == 0:
+            return
+        # Inject click track
+        if not self.click_is_muted:
+            self.metronome.render(out, position, self.bpm,
+                                  self.beats_per_loop, self.frames_per_loop)
+
+        # Inject tracks, from the snapshot published before this block
+        meter = self.meter
+        metered = frames <= meter.block.shape[1]
+        rows = 0
+        for track_index, track in enumerate(tracks):
+            if not track.is_muted and not track.is_recording:
+                buffer = track.buffer
+                # A render not filled in yet must not stop the stream
+                if buffer is None or len(buffer) == 0:
+                    continue
+                length = len(buffer)
+                # Each track wraps at its own length
+                playback_start = (
+                    self._track_start(track, length) + position
+                    + self.latency_compensation_samples) % length
+                loop_segment = buffer[playback_start:playback_start + frames]
+                if loop_segment.shape[0] < frames:
+                    if length >= frames:
+                        loop_segment = np.vstack(
+                            (loop_segment,
+                             buffer[:frames - loop_segment.shape[0]]))
+                    else:
+                        loop_segment = buffer.take(
+                            np.arange(playback_start, playback_start + frames),
+                            axis=0, mode='wrap')
+                out += loop_segment
+                if metered and track_index < meter.capacity:
+                    meter.assign(track_index, track.track_uid)
+                    meter.block[rows, :frames] = loop_segment[:, 0]
+                    meter.indices[rows] = track_index
+                    rows += 1
+        if metered:
+            meter.measure_tracks(rows, frames)
+
+    def _track_start(self, track, length: int):
+        """Returns the index into a 'length' frames long buffer of 'track'
+        that plays at the start of this loop.
+
+        Tracks as long as the loop start at index 0 of every loop. Others
+        carry on from where the previous loop left them, so a 3 beat
+        track over a 4 beat loop plays as a polymeter.
+        """
+        beats = track.beats_per_loop
+        return (self.loop_start_beat - track.start_beat) % beats * length // beats
+
+    def _write_input(self, target: slice, samples):
+        """Writes input samples into the current track's raw buffer.
+        When overdubbing, the samples are summed with saturation instead."""
+        raw_buffer = self.current_track.raw_buffer
+        if self.is_overdubbing:
+            mixed = raw_buffer[target].astype(np.int32) + samples
+            raw_buffer[target] = np.clip(mixed, -32768, 32767)
+        else:
+            raw_buffer[target] = samples
 
     def stop(self):
         """Stops the loop machine and closes the audio stream."""
         self.is_recording = False
+        self.speculative.stop()
+        self.track_pool.stop()
+        self.deferred.stop()
+        if self.storage:
+            self.storage.stop()
+        if self.journal:
+            self.journal.stop()
+        EditHistory.remove_spills()
         self.stream.stop()
         self.stream.close()
 
     def set_bpm(self, new_bpm: int):
-        """Sets new bpm."""
-        old_frames_per_loop = self.frames_per_loop
+        """Sets new bpm.
+
+        Every track is re-rendered as one batch in the process pool. The
+        loop keeps playing at the old tempo until the whole batch is done,
+        then the new tempo and all buffers are published together at the
+        next loop boundary.
+        """
+        self.target_bpm = new_bpm
+        self.pending_tempo = None
+        self.speculative.drop()
+        if not self.tracks:
+            # Nothing to render, so switch right away
+            old_frames_per_loop = self.frames_per_loop
+            self.render_batch_id = None
+            self.bpm = new_bpm
+            self.frames_per_loop = int(
+                (60 / self.bpm) * self.beats_per_loop * RATE)
+            self.position = int(
+                self.position * self.frames_per_loop / old_frames_per_loop)
+            self.track_pool.refill()
+            return
+
+        batch_id = uuid.uuid4()
+        self.render_batch_id = batch_id
+        tracks = [track for track in self.tracks
+                  if track is not self.current_track]
+
+        def on_progress(done, total):
+            if self.render_batch_id == batch_id:
+                self.render_progress = (done, total)
+
+        def worker():
+            states = {track: track.effect_state()[1:] for track in tracks}
+            rendered = [track for track in tracks
+                        if track.original_bpm != new_bpm
+                        or track.pitch_shift != 0
+                        or track.offset_beats != 0]
+            # Renders of the neighbouring tempos may already be cached
+            buffers = {}
+            for track in rendered:
+                buffer = self.speculative.lookup(track, new_bpm)
+                if buffer is not None:
+                    buffers[track] = buffer
+            missing = [track for track in rendered if track not in buffers]
+            on_progress(0, len(missing))
+            try:
+                jobs = [(track.raw_buffer, new_bpm) + states[track]
+                        for track in missing]
+                results = render_cache.render_batch(jobs, RATE, on_progress)
+            except Exception as error:
+                print(f"Could not render the new tempo: {error!r}")
+                return
+            finally:
+                if self.render_batch_id == batch_id:
+                    self.render_progress = None
+            if self.render_batch_id != batch_id:
+                return  # Superseded by a newer tempo or a load
+            buffers.update(zip(missing, results))
+            for track in tracks:
+                if track not in buffers:
+                    buffers[track] = track.raw_buffer
+            self.pending_tempo = (new_bpm,
+                                  {track: (states[track], buffers[track])
+                                   for track in tracks})
+            if not self.is_playing:
+                self._publish_tempo()
+
+        threading.Thread(target=worker, daemon=True).start()
+
+    def _publish_tempo(self):
+        """Switches to the tempo of the finished batch render, swapping in
+        every rendered buffer at once. Tracks edited or recorded since the
+        batch started are re-rendered on their own.
 
-        self.bpm = new_bpm
+        Runs in the audio callback, so only references are swapped here;
+        the rest is handed to 'deferred'.
+        """
+        bpm, buffers = self.pending_tempo
+        self.pending_tempo = None
+        if self.current_track:
+            # The raw buffer has the old length, so end the recording here
+            self.current_track.is_recording = False
+            self.deferred.put(self._finish_recording,
+                              self.current_track, self.is_overdubbing)
+            self.is_overdubbing = False
+            self.current_track = None
+        self.bpm = bpm
         self.frames_per_loop = int(
             (60 / self.bpm) * self.beats_per_loop * RATE)
-        self.click_track = generate_clicks(self.bpm, self.beats_per_loop)
-        self.position = int(
-            self.position * self.frames_per_loop / old_frames_per_loop)
-        for track in self.tracks:
-            track.bpm = new_bpm
-            track.apply_effects_async()
+        tracks = self.tracks
+        swapped = []
+        for track in tracks:
+            track.bpm = bpm
+            state, buffer = buffers.get(track, (None, None))
+            if state == track.effect_state()[1:]:
+                track.buffer = buffer
+                swapped.append(track)
+        self.deferred.put(self._after_tempo, tracks, swapped)
+
+    def _after_tempo(self, tracks, swapped):
+        """Finishes a tempo switch off the audio thread."""
+        self.track_pool.refill()
+        for track in tracks:
+            if track in swapped:
+                self._on_track_buffer_modified(track)
+            else:
+                track.apply_effects_async()
 
     def set_beats_per_loop(self, new_beats_per_loop: int):
-        """Sets new beats per loop."""
-        old_frames_per_loop = self.frames_per_loop
+        """Sets new beats per loop.
 
+        Tracks keep their own length, so nothing is re-rendered: tracks of
+        another length than the loop play against it as a polymeter. The
+        position stays on the same beat; if the loop got shorter than
+        that, it restarts at the end of the block.
+        """
         self.beats_per_loop = new_beats_per_loop
         self.frames_per_loop = int(
             (60 / self.bpm) * self.beats_per_loop * RATE)
-        self.click_track = generate_clicks(self.bpm, self.beats_per_loop)
-        self.position = int(
-            self.position * self.frames_per_loop / old_frames_per_loop)
-        for track in self.tracks:
-            track.frames_per_loop = self.frames_per_loop
-            track.apply_effects_async()
+        self.track_pool.refill()
+
+    def import_track(self, path: str, detect_tempo: bool = False):
+        """Adds an audio file as a new track, decoding it in the background.
+
+        The file is resampled to RATE and conformed to the loop length,
+        see 'audio_import.import_audio'. With 'detect_tempo' its own tempo
+        is estimated and it is time-stretched to the loop's.
+        """
+        bpm, beats_per_loop = self.bpm, self.beats_per_loop
 
-    def _prewarm(self):
-        """Prepares (or "prewarms") the system by running an initial operation
-        in a background thread."""
         def worker():
-            dummy_buffer = np.zeros(RATE, dtype=np.float32)
-            _ = librosa.effects.pitch_shift(dummy_buffer, sr=RATE, n_steps=1)
+            try:
+                raw_buffer, original_bpm = audio_import.import_audio(
+                    path, RATE, bpm, beats_per_loop, detect_tempo)
+            except (OSError, RuntimeError, ValueError) as error:
+                print(f'Could not import {path}: {error}')
+                return
+            track = Track(len(raw_buffer), original_bpm)
+            track.raw_buffer = track.buffer = raw_buffer
+            track.name = os.path.splitext(os.path.basename(path))[0]
+            track.bpm = self.bpm
+            track.start_beat = self.loop_start_beat
+            track._on_buffer_modified = self._on_track_buffer_modified
+            self._update_tracks(lambda tracks: tracks + (track,))
+            if track.has_effects():
+                track.apply_effects_async()
+            else:
+                self._on_track_buffer_modified(track)
 
         threading.Thread(target=worker, daemon=True).start()
 
+    def bounce(self, track_indices):
+        """Mixes the chosen tracks into one new track in the background.
+
+        The originals are saved to 'loops/bounces' so the bounce can be
+        undone, then replaced by the new track, which frees their buffers.
+        Muted tracks are left out of the mix, as they are on playback.
+        """
+        tracks = [self.tracks[i] for i in sorted(set(track_indices))
+                  if self.tracks[i] is not self.current_track]
+        if len(tracks) < 2:
+            print("Bounce needs at least two tracks that are not recording.")
+            return False
+
+        def worker():
+            # Long enough for every track to come round to its start again
+            beats = 1
+            for track in tracks:
+                beats = math.lcm(beats, track.beats_per_loop)
+            start_beat = self.loop_start_beat
+            frames = int((60 / self.bpm) * beats * RATE)
+            mix = np.zeros(frames, dtype=np.int32)
+            for track in tracks:
+                if not track.is_muted:
+                    mix += export.track_audio(
+                        track.buffer, track.beats_per_loop,
+                        (start_beat - track.start_beat) % track.beats_per_loop,
+                        0, frames, 1, 0)
+            bounced = Track(frames, self.bpm)
+            bounced.start_beat = start_beat
+            bounced.raw_buffer[:, 0] = np.clip(mix, -32768, 32767)
+            bounced.name = "Bounce"
+            bounced._on_buffer_modified = self._on_track_buffer_modified
+
+            # Keep the originals on disk for undo
+            undo = {
+                'track_uid': bounced.track_uid,
+                'tracks': [(self.tracks.index(track), track)
+                           for track in tracks if track in self.tracks],
+            }
+            if not undo['tracks']:
+                return  # Deleted while mixing
+            path = os.path.join(
+                'loops', 'bounces', f'{self.uid}-{bounced.track_uid}.pkl')
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            import dill
+            with open(path, 'wb') as file:
+                dill.dump(undo, file)
+            self.bounce_history.append(path)
+
+            insert_at = min(index for index, _ in undo['tracks'])
+
+            def replace(live_tracks):
+                remaining = [track for track in live_tracks
+                             if track not in tracks]
+                remaining.insert(insert_at, bounced)
+                return remaining
+
+            self._update_tracks(replace)
+            self._on_track_buffer_modified(bounced)
+
+        threading.Thread(target=worker, daemon=True).start()
+        return True
+
+    def undo_bounce(self):
+        """Restores the tracks of the most recent bounce from disk and
+        removes the bounced track."""
+        if not self.bounce_history:
+            print("Nothing to undo.")
+            return False
+        import dill
+        path = self.bounce_history.pop()
+        try:
+            with open(path, 'rb') as file:
+                undo = dill.load(file)
+        except FileNotFoundError:
+            print(f'{path} was not found.')
+            return False
+        for _, track in undo['tracks']:
+            track._on_buffer_modified = self._on_track_buffer_modified
+            # A cached render was left out of the undo file
+            track.load_render()
+            if track.bpm != self.bpm:
+                track.bpm = self.bpm
+                track.apply_effects_async()
+
+        def restore(tracks):
+            restored = [track for track in tracks
+                        if track.track_uid != undo['track_uid']]
+            for index, track in undo['tracks']:
+                restored.insert(min(index, len(restored)), track)
+            return restored
+
+        self._update_tracks(restore)
+        os.remove(path)
+        return True
+
+    def set_track_params(self, track_index: int, **fields):
+        """Sets track attributes such as 'pitch_shift' or 'offset_beats'
+        as one undoable edit, re-rendering the track if its effects
+        changed.
+
+        With 'quantize' set, the edit is scheduled for the next beat, bar
+        or loop boundary instead of being applied right away. An edit that
+        changes the effects is rendered first, in the background, and then
+        swapped in on the first boundary after the render is done, so the
+        audio thread only sets attributes.
+        """
+        track = self.tracks[track_index]
+        changes = {field: (getattr(track, field), value)
+                   for field, value in fields.items()}
+        self.history.record(('params', [(track, changes)]), self.tracks)
+
+        if not self.quantize:
+            state = track.effect_state()
+            for field, value in fields.items():
+                setattr(track, field, value)
+            if (track.effect_state() != state
+                    and track is not self.current_track):
+                track.apply_effects_async()
+            return
+
+        self._schedule_edits([(track, fields)])
+
+    def _schedule_edits(self, changes):
+        """Schedules 'changes', a list of (track, fields), for the next
+        'quantize' boundary. Tracks whose effects change are rendered
+        first, in the background, and swapped in on the first boundary
+        after the renders are done, so the audio thread only sets
+        attributes. Returns the number of tracks rendered."""
+        quantize = self.quantize
+        renders = []  # (track, raw buffer, effect state, needs effects)
+        for track, fields in changes:
+            # The track as it will be, to render its effects ahead of time
+            edited = Track.__new__(Track)
+            edited.__dict__.update(track.__dict__)
+            edited.__dict__.update(fields)
+            state = edited.effect_state()
+            if (state != track.effect_state()
+                    and track is not self.current_track):
+                renders.append((track, track.raw_buffer, state,
+                                edited.has_effects()))
+        if not renders:
+            self.scheduler.add(quantize, lambda: self._apply_params(changes))
+            return 0
+
+        def worker():
+            jobs = [(raw_buffer,) + state
+                    for _, raw_buffer, state, needs_effects in renders
+                    if needs_effects]
+            try:
+                if len(jobs) == 1:
+                    results = [render_cache.render(jobs[0][0], RATE,
+                                                   *jobs[0][1:])]
+                else:
+                    results = render_cache.render_batch(jobs, RATE)
+            except Exception as error:
+                print(f"Could not render the edited tracks: {error!r}")
+                results = [None] * len(jobs)
+            results = iter(results)
+            rendered = [(track, raw_buffer, state,
+                         next(results) if needs_effects else raw_buffer)
+                        for track, raw_buffer, state, needs_effects
+                        in renders]
+            self.scheduler.add(quantize, lambda: self._apply_params(
+                changes, rendered))
+
+        threading.Thread(target=worker, daemon=True).start()
+        return len(renders)
+
+    def _apply_params(self, changes, rendered=()):
+        """Sets the fields of quantized edits, in the audio callback, and
+        swaps in the renders made for them: (track, raw buffer, effect
+        state, buffer or None if it failed). Anything slower is handed to
+        'deferred'."""
+        for track, fields in changes:
+            for field, value in fields.items():
+                setattr(track, field, value)
+        for track, raw_buffer, state, buffer in rendered:
+            if (buffer is not None and track.raw_buffer is raw_buffer
+                    and track.effect_state() == state):
+                track.buffer = buffer
+                self.deferred.put(self._on_track_buffer_modified, track)
+            elif track is not self.current_track:
+                # Edited again or recorded into since the render started
+                self.deferred.put(track.apply_effects_async)
+
+    def duplicate_track(self, track_index: int):
+        """Appends a copy-on-write duplicate of a track."""
+        duplicate = self.tracks[track_index].duplicate()
+        self._update_tracks(lambda tracks: tracks + (duplicate,))
+        return duplicate
+
+    def _update_tracks(self, update=None):
+        """Publishes 'update(tracks)' as the new track table and returns
+        it, after merging in the tracks the audio callback started.
+
+        Control threads take turns through 'tracks_lock', so none loses
+        another's change. The callback never publishes 'tracks' itself: it
+        leaves new tracks in 'recorded', which only this merges.
+        """
+        with self.tracks_lock:
+            # Written back to the loop read from, even if a scene or a
+            # loaded loop was swapped in meanwhile
+            state = self.__dict__
+            tracks = state['tracks']
+            recorded = state['recorded']
+            while recorded:
+                tracks += (recorded.popleft(),)
+            if update:
+                tracks = tuple(update(tracks))
+            state['tracks'] = tracks
+            return tracks
+
+    def delete_tracks(self, track_indices):
+        """Removes tracks by index as one undoable edit."""
+        removed = []
+
+        def remove(tracks):
+            if tracks:
+                removed.extend((index % len(tracks), tracks[index])
+                               for index in sorted(set(track_indices)))
+            removed_tracks = [track for _, track in removed]
+            return [track for track in tracks
+                    if track not in removed_tracks]
+
+        tracks = self._update_tracks(remove)
+        if removed:
+            self.history.record(('remove', removed), tracks)
+
+    def undo(self):
+        """Undoes the most recent track edit."""
+        return self._step_history(redo=False)
+
+    def redo(self):
+        """Redoes the most recently undone track edit."""
+        return self._step_history(redo=True)
+
+    def _step_history(self, redo):
+        entry = self.history.pop(redo)
+        if entry is None:
+            print(f"Nothing to {'redo' if redo else 'undo'}.")
+            return False
+        kind, changes = entry
+        if kind == 'params' and self.quantize:
+            self._schedule_edits([
+                (track, {field: new if redo else old
+                         for field, (old, new) in fields.items()})
+                for track, fields in changes])
+        elif kind == 'params':
+            for track, fields in changes:
+                state = track.effect_state()
+                for field, (old, new) in fields.items():
+                    setattr(track, field, new if redo else old)
+                if (track.effect_state() != state
+                        and track is not self.current_track):
+                    track.apply_effects_async()
+            self._on_track_buffer_modified(changes[-1][0])
+        elif redo:
+            removed_tracks = [track for _, track in changes]
+            self._update_tracks(lambda tracks: [
+                track for track in tracks if track not in removed_tracks])
+            self._on_track_buffer_modified(removed_tracks[-1])
+        else:
+            for _, track in changes:
+                if self.history.restore(track) or track.bpm != self.bpm:
+                    track.bpm = self.bpm
+                    track.apply_effects_async()
+
+            def insert(tracks):
+                tracks = list(tracks)
+                for index, track in changes:
+                    tracks.insert(min(index, len(tracks)), track)
+                return tracks
+
+            self._update_tracks(insert)
+            self._on_track_buffer_modified(changes[-1][1])
+        self.history.push(entry, redo, self.tracks)
+        return True
+
+    def apply_batch(self, edits):
+        """Applies many track edits with one render and one UI refresh.
+
+        Each edit is a dictionary with a 'track' index and any of the
+        fields in 'BATCH_TRACK_FIELDS', e.g.
+        [{'track': 0, 'pitch_shift': 2, 'offset_beats': 0.5},
+         {'track': 2, 'is_muted': True}]
+
+        All edits are checked before any is applied; a ValueError is raised
+        for the first invalid one. Tracks whose effects changed are then
+        re-rendered together in the process pool. With 'quantize' set, the
+        edits are applied together on the next boundary after the renders,
+        like 'set_track_params'. Returns the number of tracks re-rendered.
+        """
+        tracks = list(self.tracks)
+        changes = []
+        for edit in edits:
+            if not isinstance(edit, dict):
+                raise ValueError(f"Edit {edit!r} is not a dictionary.")
+            fields = dict(edit)
+            index = fields.pop('track', None)
+            if (type(index) is not int
+                    or not -len(tracks) <= index < len(tracks)):
+                raise ValueError(f"Edit {edit!r} has no valid 'track' index.")
+            for field, value in fields.items():
+                if field not in BATCH_TRACK_FIELDS:
+                    raise ValueError(f"Unknown track field '{field}'.")
+                # JSON true/false would otherwise pass as numbers
+                if (not isinstance(value, BATCH_TRACK_FIELDS[field])
+                        or (isinstance(value, bool) and field != 'is_muted')):
+                    raise ValueError(f"Invalid value {value!r} for '{field}'.")
+                # JSON allows NaN and Infinity, which no render can use
+                if (isinstance(value, (int, float))
+                        and not math.isfinite(value)):
+                    raise ValueError(f"Invalid value {value!r} for '{field}'.")
+                if (field == 'stretch_engine'
+                        and value not in effects.STRETCH_ENGINES):
+                    raise ValueError(f"Unknown stretch engine '{value}'.")
+            changes.append((tracks[index], fields))
+        if not changes:
+            return 0
+
+        states = {track: track.effect_state() for track, _ in changes}
+        self.history.record(
+            ('params', [(track, {field: (getattr(track, field), value)
+                                 for field, value in fields.items()})
+                        for track, fields in changes]),
+            tracks)
+        if self.quantize:
+            return self._schedule_edits(changes)
+        for track, fields in changes:
+            for field, value in fields.items():
+                setattr(track, field, value)
+        rendered = [track for track in states
+                    if track.effect_state() != states[track]
+                    and track is not self.current_track]
+        if rendered:
+            self._render_tracks_async(rendered)
+        else:
+            self._on_track_buffer_modified(changes[-1][0])
+        return len(rendered)
+
+    def _render_tracks_async(self, tracks):
+        """Re-renders 'tracks' as one batch in the process pool, showing
+        its progress in 'render_progress', then notifies the UI once."""
+        shown = [None]  # Progress last shown, unless a tempo render took over
+
+        def on_progress(done, total):
+            shown[0] = self.render_progress = (done, total)
+
+        def worker():
+            states = {track: track.effect_state() for track in tracks}
+            rendered = [track for track in tracks if track.has_effects()]
+            try:
+                results = render_cache.render_batch(
+                    [(track.raw_buffer,) + states[track]
+                     for track in rendered],
+                    RATE, on_progress)
+            except Exception as error:
+                print(f"Could not render the edited tracks: {error!r}")
+                return
+            finally:
+                if self.render_progress is shown[0]:
+                    self.render_progress = None
+            buffers = dict(zip(rendered, results))
+            for track in tracks:
+                # A track edited again since has its own render running
+                if track.effect_state() == states[track]:
+                    track.buffer = buffers.get(track, track.raw_buffer)
+            self._on_track_buffer_modified(tracks[-1])
+
+        threading.Thread(target=worker, daemon=True).start()
+
+    def memory_report(self):
+        """Returns the bytes held by each track, as a list of dictionaries
+        with 'raw', 'rendered' and 'cache' keys. Arrays shared between
+        copies are counted once, on the first track that uses them."""
+        seen = set()
+        report = []
+        for track in self.tracks:
+            usage = track.memory_usage(seen)
+            usage['cache'] = self.speculative.nbytes(track)
+            report.append(usage)
+        return report
+
+    def _prewarm(self):
+        """Prepares (or "prewarms") the effects by running an initial render
+        in a background thread, once the UI has had time to start."""
+        timer = threading.Timer(PREWARM_DELAY_SECONDS, effects.prewarm,
+                                args=(RATE,))
+        timer.daemon = True
+        timer.start()
+
+    def add_scene(self, name: str, filename: str):
+        """Loads a saved loop into the scene bank as 'name', ready to be
+        switched to."""
+        return self.scenes.add(name, filename)
+
+    def switch_scene(self, name: str):
+        """Switches to scene 'name' at the next loop boundary, or right away
+        while paused. The scene playing now is kept in the bank under its
+        own name, or under "previous" if it has none."""
+        scene = self.scenes.take(name)
+        if scene is None:
+            print(f'Scene {name} was not found.')
+            return False
+        if self.pending_scene:
+            # Put back the scene that was queued before
+            self.scenes.store(*self.pending_scene)
+        self._prepare_loaded(scene)
+        self.pending_scene = (name, scene)
+        if not self.is_playing:
+            self._publish_scene()
+        return True
+
+    def _publish_scene(self):
+        """Swaps in the queued scene and puts the current one in the bank.
+
+        Runs in the audio callback, so only references are swapped here;
+        banking the old scene and notifying handlers is handed to
+        'deferred'.
+        """
+        name, scene = self.pending_scene
+        self.pending_scene = None
+        if self.current_track:
+            self.current_track.is_recording = False
+            self.deferred.put(self._finish_recording,
+                              self.current_track, self.is_overdubbing)
+            self.is_overdubbing = False
+            self.current_track = None
+        self.checkpoint_action = None
+        self.render_batch_id = None
+        self.render_progress = None
+        self.pending_tempo = None
+        self.speculative.drop()
+        # Quantized edits were meant for the tracks of this scene
+        self.scheduler.clear()
+        current = LoopMachine.__new__(LoopMachine)
+        current.__dict__ = self.__dict__
+        scene.scene_name = name
+        # O(1):
+        self.__dict__ = scene.__dict__
+        self.deferred.put(self._after_scene, current, self.tracks)
+
+    def _after_scene(self, previous, tracks):
+        """Finishes a scene switch off the audio thread. Storing may write
+        an evicted scene to disk."""
+        self.track_pool.refill()
+        self.scenes.store(previous.scene_name or "previous", previous)
+        for track in tracks:
+            self._on_track_buffer_modified(track)
+
+    def _prepare_loaded(self, loaded):
+        """Readies a loaded loop to take over this one's stream, handlers
+        and settings that aren't saved with it."""
+        loaded.is_playing = self.is_playing
+        loaded.__dict__['click_is_muted'] = self.click_is_muted
+        loaded.__dict__['stream'] = self.stream
+        # Older saves carry a full-loop click track; keep using
+        # the running metronome instead
+        loaded.__dict__.pop('click_track', None)
+        loaded.__dict__['metronome'] = self.metronome
+        # Tracks a scene's callback started but that weren't merged yet
+        recorded = tuple(loaded.__dict__.pop('recorded', None) or ())
+        # Tracks of older saves all start on the loop
+        loaded.__dict__.setdefault('loop_start_beat', 0)
+        # Attributes added since the file was saved keep their
+        # current values
+        for key, value in self.__dict__.items():
+            loaded.__dict__.setdefault(key, value)
+        loaded.on_track_buffer_modified = self.on_track_buffer_modified
+        # Older saves hold a list
+        loaded.tracks = tuple(loaded.tracks) + recorded
+        loaded.recorded = deque()
+        loaded.tracks_lock = self.tracks_lock
+        if loaded.history is None or loaded.history is self.history:
+            # Scenes switched back to keep their own history
+            loaded.history = EditHistory()
+        # Older saves may have been written mid-recording
+        loaded.tracks = tuple(track for track in loaded.tracks
+                              if not track.is_recording)
+        for track in loaded.tracks:
+            track._on_buffer_modified = self._on_track_buffer_modified
+            track.load_render()
+        loaded.current_track = None
+        loaded.checkpoint_action = None
+        loaded.is_overdubbing = False
+        loaded.overdub_track = None
+        loaded.target_bpm = loaded.bpm
+        loaded.render_batch_id = None
+        loaded.render_progress = None
+        loaded.pending_tempo = None
+        loaded.speculative = self.speculative
+        loaded.track_pool = self.track_pool
+        loaded.scheduler = self.scheduler
+        loaded.deferred = self.deferred
+        loaded.meter = self.meter
+        # Versions keep counting up across loads
+        loaded.state_log = self.state_log
+        loaded.storage = None  # Set by 'load_session' for sessions
+        loaded.journal = self.journal
+        loaded.scenes = self.scenes
+        loaded.pending_scene = None
+        loaded.frames_per_loop = int(
+            (60 / loaded.bpm) * loaded.beats_per_loop * RATE)
+        loaded.position = 0
+
     def __getstate__(self):
         """Creates a snapshot of the current state of object for pkl
         to access object data."""
@@ -309,13 +2334,74 @@ class LoopMachine:
         state = self.__dict__.copy()
         state['on_track_buffer_modified'] = None
         state['stream'] = None
+        state['pending_tempo'] = None
+        state['speculative'] = None
+        state['track_pool'] = None
+        state['scheduler'] = None
+        state['deferred'] = None
+        state['meter'] = None
+        state['state_log'] = None
+        state['storage'] = None
+        state['journal'] = None
+        state['scenes'] = None
+        state['pending_scene'] = None
+        state['history'] = None
+        # A track being recorded is left out, and so is the recording
+        # state: a loaded loop starts with nothing being recorded
+        state['tracks'] = tuple(track for track in self.tracks
+                                if not track.is_recording)
+        state['recorded'] = None
+        state['tracks_lock'] = None
+        state['current_track'] = None
+        state['overdub_track'] = None
+        state['checkpoint_action'] = None
+        state['is_overdubbing'] = False
         return state
 
+    def use_session_dir(self, session_dir: str):
+        """Keeps the track buffers in memory-mapped files in 'session_dir'
+        from now on, which also makes saving a flush, see 'save'."""
+        if self.storage:
+            self.storage.stop()
+        self.storage = TrackStorage(session_dir)
+        for track in self.tracks:
+            self.storage.store(track)
+
+    def start_autosave(self, directory: str = AUTOSAVE_DIR):
+        """Journals changes to 'directory' from now on, see 'Journal'.
+
+        If the last run did not stop cleanly, the autosaved loop is
+        recovered first.
+        """
+        if Journal.needs_recovery(directory):
+            try:
+                loaded = Journal.recover(directory)
+            except (OSError, pickle.UnpicklingError, EOFError) as error:
+                print(f"Could not recover the autosave: {error}")
+            else:
+                print("Recovered the autosaved loop.")
+                self._swap_in(loaded)
+                for track in self.tracks:
+                    if track.has_effects():
+                        track.apply_effects_async()
+        self.journal = Journal(self, directory)
+        self.journal.start()
+        # The app has no stop button, so a normal exit also counts as clean
+        atexit.register(self.journal.stop)
+
     def save(self, loop_name: str = ''):
         """Saves the loop as a Pickle, includes any linked Track objects.
 
         Ignores the stream to prevent need to close stream
+
+        Track audio goes to the blob store once per distinct buffer, so
+        the .pkl only refers to it and unchanged audio isn't written again.
+        With a session directory, the buffer files already hold the audio:
+        they are flushed and 'session.pkl' there only refers to them.
         """
+        if self.storage:
+            self._save_session()
+            return
 
         # date-time-uid-loopname.pkl:
         self.time = f'{datetime.now().strftime("%Y-%m-%d-T%H-%M-%S")}'
@@ -325,7 +2411,88 @@ class LoopMachine:
         if not os.path.exists('loops'):
             os.mkdir('loops')
         with open(os.path.join('loops', filename), 'wb') as file:
-            pickle.dump(self, file)
+            blob_store.BlobPickler(file).dump(self)
+
+    def _save_session(self):
+        """Flushes the buffer files and writes the session file."""
+        storage = self.storage
+        tracks = self.tracks
+        # Held throughout, so the files named in the session file are
+        # neither pruned nor replaced before it is written
+        with storage.lock:
+            for track in tracks:
+                storage.map(track)
+                for array in (track.raw_buffer, track.buffer):
+                    if TrackStorage.is_mapped(array):
+                        array.flush()
+            # Files of deleted tracks are kept while they can be undone
+            history = self.history
+            storage.prune(tracks + tuple(
+                track
+                for kind, changes in history.undo_stack + history.redo_stack
+                if kind == 'remove' for _, track in changes))
+            self.time = f'{datetime.now().strftime("%Y-%m-%d-T%H-%M-%S")}'
+            path = os.path.join(storage.session_dir,
+                                TrackStorage.SESSION_FILE)
+            with open(f'{path}.tmp', 'wb') as file:
+                SessionPickler(file).dump(self)
+            os.replace(f'{path}.tmp', path)
+
+    def load_session(self, session_dir: str):
+        """Loads a session saved in 'session_dir', mapping its buffer files
+        rather than reading them. Waits until the end of the loop."""
+        path = os.path.join(session_dir, TrackStorage.SESSION_FILE)
+        try:
+            with open(path, 'rb') as file:
+                loaded = SessionUnpickler(file).load()
+        except FileNotFoundError:
+            print(f'{path} was not found.')
+            return False
+        self._swap_in(loaded)
+        self.storage = TrackStorage(session_dir)
+        return True
+
+    def export(self, repetitions: int = EXPORT_REPETITIONS,
+               mixdown: bool = True, stems: bool = False,
+               file_format: str = "wav", loop_name: str = ''):
+        """Writes 'repetitions' loops to the 'exports' folder in the
+        background, as a stereo mixdown and/or one stem per track.
+
+        Renders offline from the tracks' rendered buffers, so the stream
+        is not touched and export runs much faster than realtime.
+        """
+        if file_format not in export.EXPORT_FORMATS:
+            print(f"Export format must be one of {export.EXPORT_FORMATS}.")
+            return False
+        tracks = []
+        for track in self.tracks:
+            if track.is_recording:
+                continue
+            buffer = track.buffer
+            if track is self.current_track:
+                buffer = buffer.copy()  # Overdub writes into it
+            tracks.append((track.name, track.is_muted, buffer,
+                           track.beats_per_loop,
+                           (self.loop_start_beat - track.start_beat)
+                           % track.beats_per_loop))
+        if loop_name:
+            loop_name = f'_{loop_name}'
+        prefix = os.path.join(
+            'exports',
+            f'{datetime.now().strftime("%Y-%m-%d-T%H-%M-%S")}-{self.uid}'
+            f'{loop_name}')
+        args = (tracks, self.frames_per_loop, self.beats_per_loop,
+                self.latency_compensation_samples, RATE, prefix,
+                repetitions, mixdown, stems, file_format)
+
+        def worker():
+            start = time.perf_counter()
+            paths = export.export_loop(*args)
+            print(f"Exported {len(paths)} file(s) in "
+                  f"{time.perf_counter() - start:.2f}s: {', '.join(paths)}")
+
+        threading.Thread(target=worker, daemon=True).start()
+        return True
 
     def load(self, filename: str):
         """Loads a saved loop object using the filename.
@@ -339,25 +2506,32 @@ class LoopMachine:
         """
         try:
             with open(os.path.join('loops', filename), 'rb') as file:
-                loaded = pickle.load(file)
-                # adjust while current loop is finishing
-                loaded.is_playing = self.is_playing
-                loaded.__dict__['click_is_muted'] = self.click_is_muted
-                loaded.__dict__['stream'] = self.stream
-                loaded.position = 0
-                while self.position > 0:
-                    continue
-                # O(1):
-                self.__dict__ = loaded.__dict__
-                self.frames_per_loop = int(
-                    (60 / self.bpm) * self.beats_per_loop * RATE)
-                # Reinitialize the click track
-                self.click_track = generate_clicks(
-                    self.bpm, self.beats_per_loop)
+                loaded = blob_store.BlobUnpickler(file).load()
+                self._swap_in(loaded)
 
         except FileNotFoundError:
             print(f'{filename} was not found.')
 
+    def _swap_in(self, loaded):
+        """Replaces this loop with 'loaded' at the end of the loop."""
+        # adjust while current loop is finishing
+        self._prepare_loaded(loaded)
+        loaded.scene_name = None
+        if self.pending_scene:
+            self.scenes.store(*self.pending_scene)
+            self.pending_scene = None
+        while self.position > 0:
+            continue
+        storage = self.storage
+        # O(1):
+        self.__dict__ = loaded.__dict__
+        # Quantized edits were meant for the tracks replaced
+        self.scheduler.clear()
+        self.track_pool.refill()
+        if storage:
+            # The loaded loop's buffers aren't mapped, see 'load_session'
+            storage.stop()
+
     def repr_log(self):
         """Logs the string representation of the object to 'repr_log.txt'."""
         with open('repr_log.txt', 'a') as log:
@@ -384,6 +2558,7 @@ if __name__ == "__main__":
     tempo = int(input('Tempo: '))
     beats = int(input('Beats per Loop: '))
     loop_machine = LoopMachine(tempo, beats)
+    loop_machine.start_autosave()
     print("== LoopMachine ==")
     print(
         f"Loop duration: {loop_machine.frames_per_loop} samples ({loop_machine.beats_per_loop} beats at {loop_machine.bpm} BPM)")
@@ -396,50 +2571,127 @@ if __name__ == "__main__":
 == LoopMachine ==
 
 b <INT>     set the bpm
+batch <json> apply a JSON list of track edits, e.g. [{"track": 0, "pitch_shift": 2}]
+bounce <i>.. mix tracks by index into one new track
 c           toggle click track
 d <i>       delete track by index
 dd          delete the most recent track
 h           help
+import <f> [detect]  import an audio file as a track (optionally detect its tempo)
 l           list tracks
+mem         print memory used by each track
 la <FL>     set latency samples (seconds)
+export <n> [stems] [mix] [flac]  export <n> loops (default 8) as a mixdown, stems or both
+e <i> <s>   set time-stretch engine (librosa/wsola) for track by index
 m/u <i>     mute/unmute track by index
 n <i>       set name for track by index
 o <i> <FL>  set offset beats for track by index
+overdub <i> overdub onto track by index (s to stop)
 p <i> <INT> set pitch shift for track by index
 q           quit
+quant <s>   quantize track edits to the next beat/bar/loop, or off
+undo/redo   undo or redo the last track edit (delete, pitch, offset, ...)
 r           start recording
 s           stop recording
+scene add <n> <f>  load file <f> into the scene bank as scene <n>
+scene <n>   switch to scene <n> at the end of the loop
+scenes      list the scenes in the bank
+unbounce    undo the most recent bounce
 y <i>       copy track by index
 yy          copy the most recent track
 save <n>    save the loop machine object with optional name <n>
+session <d> keep track buffers in memory-mapped files in directory <d>; save flushes them
+loadsession <d>  load the session saved in directory <d>
 load <f>    load a loop machine object with filename <f> 
+gc          delete saved audio no longer used by any loop in loops/
+perf        print timing of renders (run with OSTINATO_PROFILE=1)
 repr        print a dictionary representation of the loop
 -----------------------------------------------------------------------------------------------------------------------"""
                 print(help_text)
+            elif cmd.startswith('batch'):
+                try:
+                    edits = json.loads(cmd[len('batch'):])
+                    print(f"Re-rendering {loop_machine.apply_batch(edits)} "
+                          f"track(s)...")
+                except ValueError as error:
+                    print(error)
+            elif cmd.startswith('import'):
+                args = shlex.split(cmd)
+                loop_machine.import_track(args[1],
+                                          detect_tempo='detect' in args[2:])
+            elif cmd.startswith('bounce'):
+                loop_machine.bounce([int(arg) for arg in args[1:]])
+            elif cmd == 'unbounce':
+                loop_machine.undo_bounce()
+            elif cmd == 'undo':
+                loop_machine.undo()
+            elif cmd == 'redo':
+                loop_machine.redo()
+            elif cmd == 'scenes':
+                for name in loop_machine.scenes.names():
+                    print(f"  {name}")
+                print(f"In memory: "
+                      f"{loop_machine.scenes.nbytes() / 1024:.0f} KiB")
+            elif cmd.startswith('scene add'):
+                args = shlex.split(cmd)
+                loop_machine.add_scene(args[2], args[3])
+            elif cmd.startswith('scene'):
+                args = shlex.split(cmd)
+                loop_machine.switch_scene(args[1])
+            elif cmd.startswith('overdub'):
+                loop_machine.start_overdub(int(args[1]))
             elif cmd.startswith('b'):
                 loop_machine.set_bpm(int(args[-1]))
             elif cmd == 'c':
                 loop_machine.click_is_muted = not loop_machine.click_is_muted
             elif cmd == 'dd':
-                loop_machine.tracks.pop()
+                loop_machine.delete_tracks([-1])
             elif cmd.startswith('d'):
                 track_index = int(args[-1])
-                loop_machine.tracks.pop(track_index)
+                loop_machine.delete_tracks([track_index])
+            elif cmd.startswith('export'):
+                options = args[1:]
+                repetitions = EXPORT_REPETITIONS
+                if options and options[0].isdigit():
+                    repetitions = int(options.pop(0))
+                stems = 'stems' in options
+                loop_machine.export(
+                    repetitions,
+                    mixdown='mix' in options or not stems,
+                    stems=stems,
+                    file_format='flac' if 'flac' in options else 'wav')
+            elif cmd.startswith('e'):
+                track_index = int(args[1])
+                if args[2] in effects.STRETCH_ENGINES:
+                    loop_machine.set_track_params(track_index,
+                                                  stretch_engine=args[2])
             elif cmd == 'l':
                 print(loop_machine)
+            elif cmd == 'mem':
+                report = loop_machine.memory_report()
+                for i, usage in enumerate(report):
+                    print(f"  {i}: raw {usage['raw'] / 1024:.0f} KiB, "
+                          f"rendered {usage['rendered'] / 1024:.0f} KiB, "
+                          f"cache {usage['cache'] / 1024:.0f} KiB")
+                total = sum(sum(usage.values()) for usage in report)
+                print(f"Total: {total / 1024:.0f} KiB")
             elif cmd.startswith('la'):
                 new_latency = int(float(args[-1]) * RATE)
                 print(f"Setting latency to {new_latency}...")
                 loop_machine.latency_compensation_samples = new_latency
             elif cmd.startswith('m') or cmd.startswith('u'):
                 track_index = int(args[-1])
-                track = loop_machine.tracks[track_index]
-                track.is_muted = cmd.startswith('m')
+                loop_machine.set_track_params(
+                    track_index, is_muted=cmd.startswith('m'))
             elif cmd.startswith('n'):
                 track_index = int(args[1])
                 name = args[2]
                 track = loop_machine.tracks[track_index]
                 track.name = name
+            elif cmd.startswith('quant'):
+                option = None if args[1] == 'off' else args[1]
+                if option in QUANTIZE_OPTIONS:
+                    loop_machine.quantize = option
             elif cmd == 'q':
                 loop_machine.stop()
                 break
@@ -450,22 +2702,25 @@ repr        print a dictionary representation of the loop
             elif cmd.startswith('o'):
                 track_index = int(args[1])
                 offset_beats = float(args[2])
-                track = loop_machine.tracks[track_index]
-                track.offset_beats = offset_beats
+                loop_machine.set_track_params(track_index,
+                                              offset_beats=offset_beats)
+            elif cmd == 'perf':
+                print(perf_profile.report())
             elif cmd.startswith('p'):
                 track_index = int(args[1])
                 pitch_shift = int(args[2])
-                track = loop_machine.tracks[track_index]
-                track.pitch_shift = pitch_shift
-                track.apply_effects_async()
+                loop_machine.set_track_params(track_index,
+                                              pitch_shift=pitch_shift)
             elif cmd == 'yy':
-                track_index = -1
-                track = loop_machine.tracks[track_index]
-                loop_machine.tracks.append(copy.copy(track))
+                loop_machine.duplicate_track(-1)
             elif cmd.startswith('y'):
                 track_index = int(args[1])
-                track = loop_machine.tracks[track_index]
-                loop_machine.tracks.append(copy.copy(track))
+                loop_machine.duplicate_track(track_index)
+            elif cmd.startswith('session'):
+                loop_machine.use_session_dir(shlex.split(cmd)[1])
+            elif cmd.startswith('loadsession'):
+                loop_machine.load_session(shlex.split(cmd)[1])
+                print(loop_machine)
             elif cmd.startswith('save'):
                 args = shlex.split(cmd)
                 if len(args) == 1:
@@ -475,6 +2730,10 @@ repr        print a dictionary representation of the loop
             elif cmd.startswith('load'):
                 loop_machine.load(args[1])
                 print(loop_machine)
+            elif cmd == 'gc':
+                deleted, freed = blob_store.collect_garbage()
+                print(f"Deleted {deleted} unused blob(s), "
+                      f"{freed / 2**20:.1f} MiB.")
             elif cmd == 'repr':
                 loop_machine.repr_log()
                 print(repr(loop_machine))
@@ -4,12 +4,16 @@ from dash import dcc, html
 import dash_bootstrap_components as dbc
 from assets.layout import Layout
 import callbacks
+import perf_profile
+from LoopMachine import LATENCY_COMPENSATION_SAMPLES, METER_HZ, RATE
+import startup_timer
 
 
-bpm = callbacks.loop_machine.bpm
-tempo = callbacks.loop_machine.beats_per_loop
-latency = callbacks.loop_machine.latency_compensation_samples
-rate = callbacks.loop_machine.rate
+# The loop machine is built when the app runs, so lay out its defaults
+bpm = callbacks.beats
+tempo = callbacks.bpl
+latency = LATENCY_COMPENSATION_SAMPLES
+rate = RATE
 layout = Layout()
 
 # Initialize Dash app
@@ -22,11 +26,12 @@ app_layout = html.Div(
     className="app-container",
     children=[
 
-        # Data store and poll interval, used to trigger UI update
-        # programmatically
-        # data = is_dirty, i.e. 'True' indicates refresh is needed
-        dcc.Store(id='track_buffer_modified', data=False),
+        # State version this window last showed, and the poll that
+        # refreshes it when the loop changed, see 'refresh_ui'
+        dcc.Store(id='ui_state_version', data=0),
         dcc.Interval(id='track_buffer_poll', interval=100, n_intervals=0),
+        dcc.Interval(id='meter_poll', interval=1000 // METER_HZ,
+                     n_intervals=0),
 
         # Links css style file
         html.Link(rel="stylesheet", href=os.path.join(
@@ -109,11 +114,19 @@ callbacks.button_callbacks(app)
 callbacks.offset_callbacks(app)
 callbacks.load_save(app)
 callbacks.playhead_callback(app)
+callbacks.meter_callbacks(app)
+callbacks.control_api(app)
+perf_profile.profile_callbacks(app)
+perf_profile.debug_route(app)
+startup_timer.mark("app imported")
 
 
 def run_program():
+    callbacks.start_engine(app)
+    startup_timer.mark("engine started")
     app.run('127.0.0.1', port=8050)
 
 
 if __name__ == "__main__":
+    callbacks.start_engine(app)
     app.run(debug=False)
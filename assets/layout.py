@@ -1,8 +1,7 @@
 import dash_bootstrap_components as dbc
 from dash import dcc, html
 import numpy as np
-import pandas as pd
-import plotly_express as px
+import perf_profile
 
 
 class Layout:
@@ -27,6 +26,22 @@ class Layout:
                         children="Files",
                         n_clicks=0,
                     ),
+                    # Import audio files as new tracks
+                    dcc.Upload(
+                        className="import-upload",
+                        id="import_upload",
+                        accept=".wav,.flac,.ogg",
+                        multiple=True,
+                        children=html.Button(
+                            className="files-button",
+                            children="Import",
+                        ),
+                    ),
+                    html.Span(
+                        className="scene-text",
+                        id="scene_text",
+                        children="",
+                    ),
                 ],
             ),
             # Modal for Files
@@ -64,11 +79,20 @@ class Layout:
                     ),
                     # Close popup button
                     dbc.ModalFooter(
-                        dbc.Button(
-                            className="load-files-modal",
-                            id="load_files_modal",
-                            children="Load & Close",
-                        )
+                        children=[
+                            # Switches at the end of the loop, keeping the
+                            # current loop in memory
+                            dbc.Button(
+                                className="load-files-modal",
+                                id="scene_files_modal",
+                                children="Queue Scene",
+                            ),
+                            dbc.Button(
+                                className="load-files-modal",
+                                id="load_files_modal",
+                                children="Load & Close",
+                            ),
+                        ]
                     )
                 ]
             ),
@@ -243,6 +267,26 @@ class Layout:
                                         children="▲"),
                                 ]
                             ),
+                            # Progress of the tempo change render
+                            html.Span(
+                                className="render-progress-text",
+                                id="render_progress_text",
+                                children=""),
+                            # Master level meter and clip counter
+                            html.Div(
+                                className="master-meter-container",
+                                children=[
+                                    html.Div(
+                                        className="master-meter",
+                                        children=html.Div(
+                                            className="meter-level",
+                                            id="master_meter")),
+                                    html.Button(
+                                        className="clip-button",
+                                        id="clip_button",
+                                        children="Clips: 0"),
+                                ]
+                            ),
                             # Set latency
                             html.Div(
                                 className="latency-container",
@@ -268,7 +312,7 @@ class Layout:
             ),
 
             # Fourth row
-            # Contains save and delete buttons
+            # Contains delete, bounce and save buttons
             html.Div(
                 className="right-fourth-row-container",
                 children=[
@@ -284,6 +328,70 @@ class Layout:
                         ]
                     ),
 
+                    # Bounce button to mix the unmuted tracks into one
+                    html.Button(
+                        className="bounce-button",
+                        id="bounce_button",
+                        children=[
+                            html.Span(className="bounce-text",
+                                      children="Bounce"
+                                      )
+                        ]
+                    ),
+
+                    # Undo button for the most recent bounce
+                    html.Button(
+                        className="bounce-button",
+                        id="undo_bounce_button",
+                        children=[
+                            html.Span(className="bounce-text",
+                                      children="Undo Bounce"
+                                      )
+                        ]
+                    ),
+
+                    # Quantize button; cycles off/beat/bar/loop
+                    html.Button(
+                        className="bounce-button",
+                        id="quantize_button",
+                        children=[
+                            html.Span(className="bounce-text",
+                                      children="Quantize: Off"
+                                      )
+                        ]
+                    ),
+
+                    # Undo and redo buttons for track edits
+                    html.Button(
+                        className="bounce-button",
+                        id="undo_button",
+                        children=[
+                            html.Span(className="bounce-text",
+                                      children="Undo"
+                                      )
+                        ]
+                    ),
+                    html.Button(
+                        className="bounce-button",
+                        id="redo_button",
+                        children=[
+                            html.Span(className="bounce-text",
+                                      children="Redo"
+                                      )
+                        ]
+                    ),
+
+                    # Export button to write the mixdown and stems
+                    html.Button(
+                        className="save-button",
+                        id="export_button",
+                        children=[
+                            html.Span(className="save-text",
+                                      children="Export"
+                                      )
+                        ]
+                    ),
+
                     # Save button to save current loop
                     html.Button(
                         className="save-button",
@@ -301,6 +409,15 @@ class Layout:
 
         return right_layout
 
+    @perf_profile.profiled("layout update_track_section")
+    @staticmethod
+    def mute_icon(is_muted):
+        """
+        Returns the children of a track's mute button.
+        """
+        return [html.I(className="fa-solid fa-volume-high" if is_muted
+                       else "fa-solid fa-volume-xmark")]
+
     def update_track_section(self, track_list, input_latency=0):
         """
         Updates the track section for track layout.
@@ -316,6 +433,7 @@ class Layout:
             track_name = track["track_name"]
             pitch_shift = track["pitch_shift"]
             offset_beats = float(track["offset_beats"])
+            stretch_engine = track["stretch_engine"]
             waveform_fig = self.create_waveform(track, input_latency)
             track_section = html.Div(
                 className="track-tabs-container",
@@ -333,8 +451,9 @@ class Layout:
                                              className="track-name-input",
                                              id={"type": "track_name_input",
                                                  "index": track_index},
-                                             # Default to original <Untitled> track name
-                                             value=f"{track_name}",
+                                             # Shows <Untitled> until named
+                                             value=track_name.name or "",
+                                             placeholder="Untitled",
                                              type="text",
                                              debounce=True,
                                              autoComplete="off"
@@ -347,8 +466,16 @@ class Layout:
                                                      className="left-mute-icon-button",
                                                      id={"type": "left_mute_icon_button",
                                                          "index": track_index},
+                                                     children=self.mute_icon(
+                                                         track["is_muted"]),
+                                                 ),
+                                                 # Overdub icon button
+                                                 html.Button(
+                                                     className="overdub-button",
+                                                     id={"type": "overdub_button",
+                                                         "index": track_index},
                                                      children=[
-                                                         html.I(className="fa-solid fa-volume-xmark")],
+                                                         html.I(className="fa-solid fa-layer-group")],
                                                  ),
                                                  # Copy icon button
                                                  html.Button(
@@ -367,6 +494,14 @@ class Layout:
                                                          html.I(className="fa-solid fa-trash")],
                                                  )
                                              ]
+                                         ),
+                                         # Level meter, see 'update_meters'
+                                         html.Div(
+                                             className="track-meter",
+                                             children=html.Div(
+                                                 className="meter-level",
+                                                 id={"type": "track_meter",
+                                                     "uid": track["track_uid"]})
                                          )
                                      ]
                                  ),
@@ -422,6 +557,24 @@ class Layout:
                                                              children="▲"),
                                                      ]
                                                  ),
+
+                                                 # Time-stretch engine text and toggle
+                                                 html.Div(
+                                                     className="stretch-engine-container",
+                                                     children=[
+                                                         html.Span(
+                                                             className="stretch-engine-text",
+                                                             id={"type": "stretch_engine_text",
+                                                                 "index": track_index},
+                                                             children=f"Stretch: {stretch_engine}"
+                                                         ),
+                                                         html.Button(
+                                                             className="increase-button",
+                                                             id={"type": "stretch_engine_button",
+                                                                 "index": track_index},
+                                                             children="⇄"),
+                                                     ]
+                                                 ),
                                              ]
                                          )
                                      ]
@@ -461,14 +614,22 @@ class Layout:
             track_dict[index] = {
                 'track_name': track,
                 'pitch_shift': track.pitch_shift,
-                'offset_beats': track.offset_beats
+                'offset_beats': track.offset_beats,
+                'stretch_engine': track.stretch_engine,
+                'track_uid': str(track.track_uid),
+                'is_muted': track.is_muted
             }
         return track_dict
 
+    @perf_profile.profiled("layout create_waveform")
     def create_waveform(self, track, latency_comp=0):
         """
         Creates the audio waveform for the track section.
         """
+        # Imported on first use to keep the app's start-up fast
+        import pandas as pd
+        import plotly_express as px
+
         # grab buffered audio from track:
         audio_data = track['track_name'].buffer
         shifted_audio = np.roll(audio_data, -latency_comp + 150)
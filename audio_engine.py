@@ -0,0 +1,450 @@
+import atexit
+import copyreg
+import effects
+import io
+import mmap
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+import os
+import perf_profile
+import pickle
+import threading
+import time
+import types
+import weakref
+from LoopMachine import (EditHistory, EventScheduler, LevelMeter, LoopMachine,
+                         SceneBank, StateLog, Track, TrackStorage)
+
+# Opt-out: set OSTINATO_ENGINE_PROCESS=0 to run the loop machine inside
+# the app's process, as before.
+ENABLED = os.environ.get("OSTINATO_ENGINE_PROCESS", "1") not in ("", "0")
+ENGINE_PROFILE_FILE = "perf_profile_engine.txt"  # Renders are timed here
+SHARED_MIN_BYTES = 4096  # Smaller arrays are copied into the reply
+# Objects the app calls methods on inside the engine rather than copying
+REMOTE_TYPES = (LevelMeter, StateLog, SceneBank, EventScheduler, EditHistory)
+# Loop machine attributes the UI polls, read from the status block
+STATUS_FIELDS = ('bpm', 'beats_per_loop', 'frames_per_loop', 'position',
+                 'rate', 'latency_compensation_samples', 'scene_name',
+                 'render_progress', 'quantize', 'uid')
+STATUS_SECONDS = 0.02  # How often the engine publishes its status
+STATUS_BYTES = 1024 * 1024  # Size of the status block
+STATUS_READ_TRIES = 100  # Then the app asks the engine instead
+
+
+class _Method:
+    """Reply to reading a method, which the proxy then calls remotely.
+    'fixed' methods are defined by the class, so the proxy remembers
+    them instead of asking again."""
+
+    def __init__(self, fixed=False):
+        self.fixed = fixed
+
+
+class _Remote:
+    """Reply to reading one of 'REMOTE_TYPES', which the proxy wraps."""
+
+
+class SharedArrays:
+    """Mirrors the engine's arrays in shared memory, once per array, so
+    the app can read track buffers without them being copied through the
+    pipe. A mirror is unlinked when its array is garbage collected.
+
+    Only for arrays that aren't shared already: track buffers recorded or
+    rendered in the engine are allocated in shared memory, and buffers
+    mapped from session files are read from the files, see
+    'ReplyPickler'."""
+
+    def __init__(self):
+        self._mirrors = {}  # id(array) -> (weak reference, SharedMemory)
+        self._lock = threading.Lock()
+
+    def name(self, array):
+        """Returns the name of the shared memory block mirroring 'array'."""
+        key = id(array)
+        with self._lock:
+            mirror = self._mirrors.get(key)
+        if mirror and mirror[0]() is array:
+            return mirror[1].name
+        block = shared_memory.SharedMemory(create=True,
+                                           size=max(array.nbytes, 1))
+        np.ndarray(array.shape, array.dtype, buffer=block.buf)[...] = array
+
+        def on_collected(reference):
+            with self._lock:
+                if key in self._mirrors and self._mirrors[key][0] is reference:
+                    self._release(self._mirrors.pop(key)[1])
+
+        with self._lock:
+            previous = self._mirrors.get(key)
+            self._mirrors[key] = (weakref.ref(array, on_collected), block)
+        if previous:
+            self._release(previous[1])
+        return block.name
+
+    def clear(self):
+        with self._lock:
+            mirrors, self._mirrors = self._mirrors, {}
+        for _, block in mirrors.values():
+            self._release(block)
+
+    @staticmethod
+    def _release(block):
+        # Blocks the app still maps stay readable until it lets go of them
+        block.close()
+        block.unlink()
+
+
+class EngineStatus:
+    """The state the UI polls, published by the engine in a shared memory
+    block the app reads without asking the engine: 'get' maps attribute
+    paths to values, 'call' maps (method path, arguments) to results.
+
+    A seqlock like 'LevelMeter': the sequence is odd while the engine
+    writes, and the app retries if it was odd or changed while it
+    copied. The app only unpickles a status once.
+    """
+
+    HEADER_BYTES = 16  # Sequence and status length, as uint64
+
+    def __init__(self, name=None):
+        """Creates the block, or maps the engine's block 'name'."""
+        self.block = shared_memory.SharedMemory(
+            name=name, create=name is None, size=STATUS_BYTES)
+        self.name = self.block.name
+        self._header = np.ndarray(2, np.uint64, buffer=self.block.buf)
+        self._read = (0, {'get': {}, 'call': {}})  # Last (sequence, status)
+
+    def publish(self, status):
+        """Writes 'status'. Only one thread may publish at a time."""
+        data = pickle.dumps(status, pickle.HIGHEST_PROTOCOL)
+        if len(data) > STATUS_BYTES - self.HEADER_BYTES:
+            # The app asks the engine for everything instead
+            print(f"Engine status of {len(data)} bytes not published.")
+            data = pickle.dumps({'get': {}, 'call': {}})
+        header = self._header
+        header[0] += 1
+        header[1] = len(data)
+        self.block.buf[self.HEADER_BYTES:self.HEADER_BYTES + len(data)] = data
+        header[0] += 1
+
+    def read(self):
+        """Returns the last status published, or an empty one if the
+        engine is stuck writing it."""
+        header = self._header
+        for _ in range(STATUS_READ_TRIES):
+            sequence = int(header[0])
+            if sequence == self._read[0]:
+                return self._read[1]
+            if sequence % 2 == 0:
+                length = min(int(header[1]),
+                             STATUS_BYTES - self.HEADER_BYTES)
+                data = bytes(self.block.buf[
+                    self.HEADER_BYTES:self.HEADER_BYTES + length])
+                if int(header[0]) == sequence:
+                    status = pickle.loads(data)
+                    self._read = (sequence, status)
+                    return status
+            time.sleep(0)
+        return {'get': {}, 'call': {}}
+
+    def unlink(self):
+        self.block.unlink()
+
+
+class ReplyPickler(pickle.Pickler):
+    """Pickles replies to the app, passing large arrays as shared memory
+    names or the files they are mapped from, and tracks with their
+    rendered buffer."""
+
+    def __init__(self, file, arrays, sent):
+        super().__init__(file, pickle.HIGHEST_PROTOCOL)
+        self.arrays = arrays
+        self.sent = sent  # Arrays kept alive until the app has mapped them
+
+    def persistent_id(self, obj):
+        if not isinstance(obj, np.ndarray) or obj.nbytes < SHARED_MIN_BYTES:
+            return None
+        self.sent.append(obj)
+        name = effects.shared_name(obj)
+        if name is not None:
+            return ('shared', name, obj.dtype.str, obj.shape)
+        # A whole session file, which is never rewritten; not a view of one
+        if TrackStorage.is_mapped(obj) and isinstance(obj.base, mmap.mmap):
+            return ('file', obj.filename, obj.offset, obj.dtype.str,
+                    obj.shape)
+        return ('shared', self.arrays.name(obj), obj.dtype.str, obj.shape)
+
+    def reducer_override(self, obj):
+        if type(obj) is Track:
+            # Not 'Track.__getstate__', which leaves out a cached render
+            state = obj.__dict__.copy()
+            state['_on_buffer_modified'] = None
+            return copyreg.__newobj__, (Track,), state
+        return NotImplemented
+
+
+class ReplyUnpickler(pickle.Unpickler):
+    """Maps the shared memory blocks and files referenced by a
+    'ReplyPickler'."""
+
+    _mapped = weakref.WeakValueDictionary()  # Block name or path -> array
+
+    def persistent_load(self, pid):
+        kind, name = pid[:2]
+        array = self._mapped.get(name)
+        if array is not None:
+            return array
+        if kind == 'file':
+            _, path, offset, dtype, shape = pid
+            array = np.memmap(path, dtype, mode='r', offset=offset,
+                              shape=shape)
+        else:
+            _, name, dtype, shape = pid
+            block = shared_memory.SharedMemory(name=name)
+            array = np.ndarray(shape, dtype, buffer=block.buf)
+            weakref.finalize(array, block.close)
+        self._mapped[name] = array
+        return array
+
+
+class EngineServer:
+    """Runs the loop machine in the engine process and answers the app's
+    requests from a thread of its own.
+
+    The audio callback never touches the pipe: the server sets attributes
+    and calls methods the same way the app used to, and the callback
+    picks the changes up through the snapshots and checkpoints it
+    already reads without locks.
+
+    The state the UI polls is published to 'status' every STATUS_SECONDS
+    and before replying to any change, so the app reads its own changes.
+    """
+
+    def __init__(self, connection, loop_machine):
+        self.connection = connection
+        self.loop_machine = loop_machine
+        self.arrays = SharedArrays()
+        self.status = EngineStatus()
+        self._status_lock = threading.Lock()
+        self._is_serving = True
+        self._sent = []
+
+    def serve(self):
+        threading.Thread(target=self._run_status, daemon=True).start()
+        while True:
+            try:
+                request = self.connection.recv()
+            except (EOFError, OSError):
+                self._is_serving = False
+                return  # The app exited
+            self._sent = []
+            try:
+                reply = ('ok', self._handle(*request))
+            except Exception as error:
+                reply = ('error', error)
+            if request[0] != 'get':
+                self.publish_status()
+            self._send(reply)
+
+    def publish_status(self):
+        """Publishes the state the UI polls, see 'EngineStatus'."""
+        loop_machine = self.loop_machine
+        # Read and written under one lock, so an older status never
+        # replaces a newer one
+        with self._status_lock:
+            try:
+                meter, state_log = loop_machine.meter, loop_machine.state_log
+                version, _ = state_log.snapshot()
+                status = {
+                    'get': {(field,): getattr(loop_machine, field)
+                            for field in STATUS_FIELDS},
+                    'call': {
+                        (('meter', 'read'), ()): meter.read(),
+                        (('state_log', 'changes_since'), (version,)):
+                            state_log.changes_since(version),
+                    },
+                }
+                status['get']['meter', 'master_clips'] = meter.master_clips
+                self.status.publish(status)
+            except Exception as error:
+                print(f"Engine status not published: {error}")
+
+    def _run_status(self):
+        while self._is_serving:
+            self.publish_status()
+            time.sleep(STATUS_SECONDS)
+
+    def _resolve(self, path):
+        target = self.loop_machine
+        for name in path:
+            target = getattr(target, name)
+        return target
+
+    def _handle(self, kind, path, args=(), kwargs=None):
+        if kind == 'get':
+            value = self._resolve(path)
+            if isinstance(value, REMOTE_TYPES):
+                return _Remote()
+            if callable(value) and not isinstance(value, type):
+                return _Method(
+                    isinstance(value, types.MethodType)
+                    and path[-1] not in getattr(value.__self__,
+                                                '__dict__', {}))
+            return value
+        if kind == 'set':
+            setattr(self._resolve(path[:-1]), path[-1], args[0])
+            return None
+        if kind == 'call':
+            return self._resolve(path)(*args, **(kwargs or {}))
+        raise ValueError(f"Unknown engine request '{kind}'.")
+
+    def _send(self, reply):
+        file = io.BytesIO()
+        try:
+            ReplyPickler(file, self.arrays, self._sent).dump(reply)
+        except Exception as error:
+            file = io.BytesIO()
+            ReplyPickler(file, self.arrays, self._sent).dump(
+                ('error', RuntimeError(f"Engine reply not sent: {error}")))
+        self.connection.send_bytes(file.getbuffer())
+
+
+def _run_engine(connection, bpm: int, beats_per_loop: int, autosave: bool):
+    """Entry point of the engine process."""
+    if perf_profile.ENABLED:
+        atexit.register(perf_profile.dump, ENGINE_PROFILE_FILE)
+    loop_machine = LoopMachine(bpm=bpm, beats_per_loop=beats_per_loop)
+    if autosave:
+        loop_machine.start_autosave()
+    server = EngineServer(connection, loop_machine)
+    connection.send(('ready', server.status.name))
+    try:
+        server.serve()
+    finally:
+        loop_machine.stop()
+        server.arrays.clear()
+        server.status.unlink()
+        effects.shutdown_process_pools()
+
+
+class EngineProxy:
+    """Stands in for a 'LoopMachine' running in the engine process.
+
+    Reading an attribute returns a copy of its value, with large arrays
+    mapped from shared memory; methods and setting attributes are
+    forwarded to the engine. Objects such as 'loop_machine.meter' are
+    proxied too, so their methods run in the engine. Copies are read
+    only: change tracks through methods like 'set_track_params'.
+
+    What the UI polls, such as 'bpm' or 'meter.read()', is read from the
+    engine's status block instead, see 'EngineStatus'.
+    """
+
+    def __init__(self, channel, path=()):
+        object.__setattr__(self, '_channel', channel)
+        object.__setattr__(self, '_path', path)
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        channel = self._channel
+        path = self._path + (name,)
+        value = channel.kinds.get(path)
+        if value is None:
+            published = channel.status.read()['get']
+            if path in published:
+                return published[path]
+            value = channel.request('get', path)
+        if isinstance(value, _Method):
+            if value.fixed:
+                channel.kinds[path] = value
+            return lambda *args, **kwargs: channel.call(path, args, kwargs)
+        if isinstance(value, _Remote):
+            channel.kinds[path] = value
+            return EngineProxy(channel, path)
+        return value
+
+    def __setattr__(self, name, value):
+        self._channel.request('set', self._path + (name,), (value,))
+
+    def __repr__(self):
+        return self._channel.request('call', self._path + ('__repr__',))
+
+    def __str__(self):
+        return self._channel.request('call', self._path + ('__str__',))
+
+
+class EngineChannel:
+    """The app's end of the pipe to the engine process. Requests from
+    the app's threads take turns."""
+
+    def __init__(self, connection, process, status):
+        self.connection = connection
+        self.process = process
+        self.status = status  # The engine's 'EngineStatus'
+        self.kinds = {}  # Path -> fixed '_Method' or '_Remote'
+        self._lock = threading.Lock()
+
+    def call(self, path, args, kwargs):
+        """Calls a method in the engine, unless its result is published."""
+        if not kwargs:
+            published = self.status.read()['call']
+            try:
+                return published[path, args]
+            except (KeyError, TypeError):  # TypeError: unhashable arguments
+                pass
+        return self.request('call', path, args, kwargs)
+
+    def request(self, kind, path, args=(), kwargs=None):
+        with self._lock:
+            if self.connection.closed:
+                raise RuntimeError("The audio engine has stopped.")
+            self.connection.send((kind, path, args, kwargs))
+            # Unpickled under the lock, so shared arrays are mapped
+            # before the engine can release them
+            status, value = ReplyUnpickler(
+                io.BytesIO(self.connection.recv_bytes())).load()
+        if status == 'error':
+            raise value
+        return value
+
+    def close(self):
+        """Stops the engine process, which stops the loop machine."""
+        with self._lock:
+            if self.connection.closed:
+                return
+            self.connection.close()
+        self.process.join()
+
+
+def start(bpm: int, beats_per_loop: int, autosave: bool = True):
+    """Starts the loop machine in an engine process of its own and returns
+    an 'EngineProxy' for it, or the loop machine itself if the engine
+    process is turned off.
+
+    The engine process only runs the audio stream and the loop machine's
+    own threads, so work in the app, however heavy, can't hold up the
+    audio callback.
+    """
+    if not ENABLED:
+        loop_machine = LoopMachine(bpm=bpm, beats_per_loop=beats_per_loop)
+        if autosave:
+            loop_machine.start_autosave()
+        return loop_machine
+    context = multiprocessing.get_context("spawn")
+    connection, engine_connection = context.Pipe()
+    # Not a daemon: the engine starts render processes of its own
+    process = context.Process(
+        target=_run_engine, name="audio engine",
+        args=(engine_connection, bpm, beats_per_loop, autosave))
+    process.start()
+    engine_connection.close()
+    try:
+        _, status_name = connection.recv()  # Wait until the stream is open
+    except EOFError:
+        raise RuntimeError("The audio engine did not start.") from None
+    channel = EngineChannel(connection, process, EngineStatus(status_name))
+    # Closing the pipe lets the engine stop cleanly before exit joins it
+    atexit.register(channel.close)
+    return EngineProxy(channel)
@@ -0,0 +1,93 @@
+import hashlib
+import numpy as np
+import os
+import soundfile as sf
+import tempfile
+
+IMPORT_FORMATS = (".wav", ".flac", ".ogg")
+IMPORT_CACHE_DIR = os.path.join("loops", "imports")
+DECODE_BLOCK_FRAMES = 1 << 16  # Frames decoded at a time
+HASH_BLOCK_BYTES = 1 << 20
+
+
+def file_hash(path: str):
+    """Returns the SHA-256 hex digest of a file's contents."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(HASH_BLOCK_BYTES), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def decode(path: str, sample_rate: int):
+    """Decodes an audio file block by block into mono float32 at
+    'sample_rate'."""
+    blocks = []
+    with sf.SoundFile(path) as file:
+        file_rate = file.samplerate
+        for block in file.blocks(DECODE_BLOCK_FRAMES, dtype='float32',
+                                 always_2d=True):
+            blocks.append(block.mean(axis=1))
+    y = np.concatenate(blocks) if blocks else np.zeros(0, dtype=np.float32)
+    if file_rate != sample_rate:
+        # Imported on first use, like in 'effects'
+        import librosa
+        y = librosa.resample(y, orig_sr=file_rate, target_sr=sample_rate)
+    return y
+
+
+def detect_bpm(y, sample_rate: int):
+    """Returns the estimated tempo of 'y', or None if no beat was found."""
+    import librosa.beat
+    tempo, _ = librosa.beat.beat_track(y=y, sr=sample_rate)
+    tempo = float(np.atleast_1d(tempo)[0])
+    return round(tempo) if tempo > 0 else None
+
+
+def conform(y, frames: int):
+    """Trims 'y' to 'frames' or pads it with silence, and returns it as an
+    int16 buffer shaped like 'Track.raw_buffer'."""
+    raw_buffer = np.zeros((frames, 1), dtype=np.int16)
+    samples = np.clip(y[:frames], -1, 1) * 32767
+    raw_buffer[:len(samples), 0] = samples.astype(np.int16)
+    return raw_buffer
+
+
+def import_audio(path: str, sample_rate: int, bpm: float,
+                 beats_per_loop: int, detect_tempo: bool = False):
+    """Returns (raw_buffer, original_bpm) for an audio file conformed to a
+    loop of 'beats_per_loop' beats.
+
+    Without 'detect_tempo' the file is taken to be at 'bpm'. With it, its
+    tempo is estimated and the loop keeps that tempo, so the track is
+    time-stretched to 'bpm' like a recorded one. Results are cached in
+    'IMPORT_CACHE_DIR' by file hash and settings, so re-importing the
+    same file skips decoding.
+    """
+    if os.path.splitext(path)[1].lower() not in IMPORT_FORMATS:
+        raise ValueError(f"Can only import {', '.join(IMPORT_FORMATS)} files.")
+    tempo = "detect" if detect_tempo else bpm
+    cache_path = os.path.join(
+        IMPORT_CACHE_DIR,
+        f'{file_hash(path)}-{sample_rate}-{tempo}-{beats_per_loop}.npz')
+    try:
+        with np.load(cache_path) as cached:
+            return cached['raw_buffer'], cached['original_bpm'].item()
+    except (FileNotFoundError, KeyError, ValueError):
+        pass
+
+    y = decode(path, sample_rate)
+    original_bpm = bpm
+    if detect_tempo:
+        original_bpm = detect_bpm(y, sample_rate) or bpm
+    frames = int((60 / original_bpm) * beats_per_loop * sample_rate)
+    raw_buffer = conform(y, frames)
+
+    os.makedirs(IMPORT_CACHE_DIR, exist_ok=True)
+    # Written under a unique temporary name so a partial file is never
+    # read, even if two threads import the same file
+    with tempfile.NamedTemporaryFile(dir=IMPORT_CACHE_DIR, suffix='.tmp',
+                                     delete=False) as file:
+        np.savez(file, raw_buffer=raw_buffer, original_bpm=original_bpm)
+    os.replace(file.name, cache_path)
+    return raw_buffer, original_bpm
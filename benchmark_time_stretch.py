@@ -0,0 +1,64 @@
+import effects
+import librosa.effects
+import numpy as np
+import time
+
+# Compares the time-stretch engines on a synthetic drum loop: render time,
+# output length against the loop length ('frames_per_loop'), and how sharp
+# the hits stay (peak right after each beat over the peak just before it)
+SAMPLE_RATE = 44100
+BEATS = 8
+TEMPO_CHANGES = [(120, 100), (120, 140), (100, 150), (90, 60)]
+REPEATS = 3
+
+
+def drum_loop(bpm, beats):
+    """Decaying noise bursts on every beat over a low sine."""
+    frames = int((60 / bpm) * beats * SAMPLE_RATE)
+    t = np.arange(frames) / SAMPLE_RATE
+    y = 0.2 * np.sin(2 * np.pi * 110 * t)
+    burst = np.random.default_rng(0).standard_normal(4000) * \
+        np.exp(-np.arange(4000) / 600) * 0.5
+    for beat in range(beats):
+        onset = int(beat * frames / beats)
+        y[onset:onset + len(burst)] += burst[:frames - onset]
+    return y.astype(np.float32)
+
+
+def sharpness(y, beats):
+    """Average ratio of the peak after each beat to the peak before it."""
+    ratios = []
+    for beat in range(1, beats):
+        onset = int(beat * len(y) / beats)
+        after = np.abs(y[onset:onset + 100]).max()
+        before = np.abs(y[onset - 300:onset - 50]).max()
+        ratios.append(after / (before + 1e-6))
+    return np.mean(ratios)
+
+
+def best_time(stretch):
+    """Runs 'stretch' once to warm up, then returns its best time and result."""
+    result = stretch()
+    times = []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        result = stretch()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+print(f"{'Tempo':>10} {'Engine':>8} {'Time (s)':>9} {'Len err':>8} {'Sharpness':>10}")
+for original_bpm, bpm in TEMPO_CHANGES:
+    y = drum_loop(original_bpm, BEATS)
+    frames_per_loop = int((60 / bpm) * BEATS * SAMPLE_RATE)
+    engines = {
+        "librosa": lambda: librosa.effects.time_stretch(
+            y, rate=bpm / original_bpm),
+        "wsola": lambda: effects.wsola_time_stretch(
+            y, BEATS, frames_per_loop),
+    }
+    for engine, stretch in engines.items():
+        seconds, result = best_time(stretch)
+        print(f"{original_bpm:>4}->{bpm:<5} {engine:>8} {seconds:>9.3f} "
+              f"{len(result) - frames_per_loop:>8} "
+              f"{sharpness(result, BEATS):>10.2f}")
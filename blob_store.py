@@ -0,0 +1,139 @@
+import glob
+import hashlib
+import numpy as np
+import os
+import pickle
+import threading
+import weakref
+
+BLOB_DIR = os.path.join("loops", "blobs")
+BLOB_MIN_BYTES = 4096  # Smaller arrays stay inside the pickle
+
+_digests = {}  # id(array) -> (weak reference, digest) of hashed arrays
+_digests_lock = threading.Lock()
+
+
+def digest(array):
+    """Returns the SHA-256 hex digest of an array's dtype, shape and data.
+
+    Digests are cached per array, so saving unchanged tracks again does
+    not hash their audio again. Call 'forget' after changing an array in
+    place.
+    """
+    with _digests_lock:
+        cached = _digests.get(id(array))
+    if cached and cached[0]() is array:
+        return cached[1]
+    hasher = hashlib.sha256(f'{array.dtype.str}{array.shape}'.encode())
+    hasher.update(np.ascontiguousarray(array).data)
+    result = hasher.hexdigest()
+    _remember(array, result)
+    return result
+
+
+def _remember(array, result):
+    key = id(array)
+
+    def on_collected(_):
+        with _digests_lock:
+            if key in _digests and _digests[key][0]() is None:
+                del _digests[key]
+
+    with _digests_lock:
+        _digests[key] = (weakref.ref(array, on_collected), result)
+
+
+def forget(array):
+    """Drops the cached digest of an array that was changed in place."""
+    with _digests_lock:
+        _digests.pop(id(array), None)
+
+
+def blob_path(blob_digest: str):
+    return os.path.join(BLOB_DIR, f'{blob_digest}.npy')
+
+
+def store(array):
+    """Writes 'array' to the store unless it is already there, and
+    returns its digest."""
+    blob_digest = digest(array)
+    path = blob_path(blob_digest)
+    if not os.path.exists(path):
+        os.makedirs(BLOB_DIR, exist_ok=True)
+        # Written under a temporary name so a partial blob is never read
+        temporary_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temporary_path, 'wb') as file:
+            np.save(file, array)
+        os.replace(temporary_path, path)
+    return blob_digest
+
+
+def load(blob_digest: str):
+    """Reads an array from the store."""
+    array = np.load(blob_path(blob_digest))
+    _remember(array, blob_digest)
+    return array
+
+
+class BlobPickler(pickle.Pickler):
+    """Pickles arrays as references to blobs in the store, so audio that
+    is already there is not written again. Saves made with dill still
+    load, see 'LoopMachine.SessionPickler'."""
+
+    def persistent_id(self, obj):
+        if isinstance(obj, np.ndarray) and obj.nbytes >= BLOB_MIN_BYTES:
+            return ('blob', store(obj))
+        return None
+
+
+class BlobUnpickler(pickle.Unpickler):
+    """Reads the blobs referenced by a 'BlobPickler'. Arrays that were
+    shared when saved are shared again."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._arrays = {}
+
+    def persistent_load(self, pid):
+        kind, blob_digest = pid
+        if blob_digest not in self._arrays:
+            self._arrays[blob_digest] = load(blob_digest)
+        return self._arrays[blob_digest]
+
+
+class _ReferenceCollector(pickle.Unpickler):
+    """Unpickles without reading blobs, collecting the digests used."""
+
+    def __init__(self, file, references):
+        super().__init__(file)
+        self.references = references
+
+    def persistent_load(self, pid):
+        if pid[0] == 'blob':
+            self.references.add(pid[1])
+        return None
+
+
+def collect_garbage(loops_dir: str = "loops"):
+    """Deletes blobs no longer referenced by a saved loop in 'loops_dir'.
+
+    Returns (blobs deleted, bytes freed). Files that can't be read are
+    reported and skipped, and nothing is deleted, since their
+    references are unknown.
+    """
+    references = set()
+    for path in glob.glob(os.path.join(loops_dir, '**', '*.pkl'),
+                          recursive=True):
+        try:
+            with open(path, 'rb') as file:
+                _ReferenceCollector(file, references).load()
+        except Exception as error:
+            print(f"Could not read {path}, no blobs deleted: {error}")
+            return 0, 0
+    deleted, freed = 0, 0
+    for path in glob.glob(os.path.join(BLOB_DIR, '*.npy')):
+        if os.path.basename(path)[:-len('.npy')] not in references:
+            freed += os.path.getsize(path)
+            os.remove(path)
+            deleted += 1
+    return deleted, freed
@@ -1,17 +1,34 @@
+import base64
 import dash
 from dash import html, MATCH, ALL
 from dash.dependencies import Input, Output, State
 import os
 import glob
 from dash.exceptions import PreventUpdate
+import flask
 import json
-import copy
-from LoopMachine import LoopMachine
+import uuid
+import audio_engine
+import effects
+from LoopMachine import QUANTIZE_OPTIONS
 from assets.layout import Layout
 
 bpl = 5
 beats = 120
-loop_machine = LoopMachine(bpm=beats, beats_per_loop=bpl)
+loop_machine = None  # Built by 'start_engine' when the app is run
+
+
+def start_engine(app):
+    """Starts the loop machine in the audio engine process, which opens
+    the audio stream, see 'audio_engine.start'.
+
+    Called when the app is run rather than on import, so importing the
+    app stays cheap and spawned render processes don't open a stream.
+    """
+    global loop_machine
+    if loop_machine is None:
+        loop_machine = audio_engine.start(bpm=beats, beats_per_loop=bpl)
+    return loop_machine
 
 
 def get_track_index_button_id():
@@ -99,25 +116,62 @@ def button_callbacks(app):
     def mute_unmute_track(n_clicks):
         """
         Toggles between mute and unmute buttons for TRACKS.
-        Mutes track if mute button is clicked.
-        Unmutes track if unmute button is clicked.
+        Mutes track if it is playing, unmutes it if it is muted.
+        """
+        track_index, _ = get_track_index_button_id()
+        tracks = loop_machine.tracks
+        if track_index >= len(tracks):
+            raise PreventUpdate
+        # Quantized mutes wait for the next boundary
+        is_muted = not tracks[track_index].is_muted
+        loop_machine.set_track_params(track_index, is_muted=is_muted)
+        return Layout.mute_icon(is_muted)
+
+    @app.callback(
+        Output({"type": "overdub_button", "index": MATCH}, "className"),
+        Input({"type": "overdub_button", "index": MATCH}, "n_clicks"),
+        prevent_initial_call=True
+    )
+    def overdub_track(n_clicks):
+        """
+        Toggles overdubbing onto a TRACK.
+        Odd clicks start summing the input into the track, even clicks stop.
         """
         track_index, _ = get_track_index_button_id()
-        track = loop_machine.tracks[track_index]
-        # odd clicks are mutes
         if n_clicks % 2 != 0:
-            track.is_muted = True
-            mute = [
-                html.I(className="fa-solid fa-volume-high")
-            ]
-            return mute
-        else:
-            # even clicks are unmutes
-            track.is_muted = False
-            unmute = [
-                html.I(className="fa-solid fa-volume-xmark"),
-            ]
-            return unmute
+            if loop_machine.start_overdub(track_index):
+                return "overdub-button overdubbing"
+            raise PreventUpdate
+        loop_machine.stop_recording()
+        return "overdub-button"
+
+    @app.callback(
+        Output("bounce_button", "children"),
+        Input("bounce_button", "n_clicks"),
+        prevent_initial_call=True
+    )
+    def bounce_tracks(n_clicks):
+        """
+        Bounces every unmuted track into one new track in the background.
+        The track section refreshes through 'track_buffer_poll' when done.
+        """
+        track_indices = [index for index, track in
+                         enumerate(loop_machine.tracks) if not track.is_muted]
+        loop_machine.bounce(track_indices)
+        return dash.no_update
+
+    @app.callback(
+        Output("track_section", "children", allow_duplicate=True),
+        Input("undo_bounce_button", "n_clicks"),
+        prevent_initial_call=True
+    )
+    def undo_bounce(n_clicks):
+        """Restores the tracks of the most recent bounce."""
+        if not loop_machine.undo_bounce():
+            raise PreventUpdate
+        updated_track_section = Layout().update_track_section(
+            loop_machine.tracks, loop_machine.latency_compensation_samples)
+        return updated_track_section
 
     @app.callback(
         Output("track_section", "children", allow_duplicate=True),
@@ -129,13 +183,11 @@ def button_callbacks(app):
         if not any(n_clicks):
             raise PreventUpdate
         track_index, _ = get_track_index_button_id()
-        track_list = loop_machine.tracks
-        track = track_list[track_index]
-        # copy track
-        track_list.append(copy.copy(track))
+        # copy track; the copy shares its audio until its effects change
+        loop_machine.duplicate_track(track_index)
         # Update the track sections
         updated_track_section = Layout().update_track_section(
-            track_list, loop_machine.latency_compensation_samples)
+            loop_machine.tracks, loop_machine.latency_compensation_samples)
         return updated_track_section
 
     @app.callback(
@@ -150,11 +202,11 @@ def button_callbacks(app):
         if not any(n_clicks):
             raise PreventUpdate
         track_index, _ = get_track_index_button_id()
-        track_list = loop_machine.tracks
-        # Remove the track from track_list
-        track_list.pop(track_index)
+        # Remove the track from track_list, so that it can be undone
+        loop_machine.delete_tracks([track_index])
         # Update the track sections
-        updated_track_section = Layout().update_track_section(track_list)
+        updated_track_section = Layout().update_track_section(
+            loop_machine.tracks)
         return updated_track_section
 
     @app.callback(
@@ -166,10 +218,14 @@ def button_callbacks(app):
         """Updates the track name to whatever the user input."""
         # get track_index
         track_index, _ = get_track_index_button_id()
-        # Update track name in track list
-        track = loop_machine.tracks[track_index]
-        track.name = new_name
-        return str(new_name)
+        tracks = loop_machine.tracks
+        # Also set by 'refresh_ui' when another window renamed the track
+        if (track_index >= len(tracks)
+                or (tracks[track_index].name or "") == (new_name or "")):
+            raise PreventUpdate
+        # Update track name in the engine; 'tracks' only returns copies
+        loop_machine.set_track_params(track_index, name=new_name or None)
+        return new_name or ""
 
     @app.callback(
         Output("mute_unmute_click_button", "children"),
@@ -233,10 +289,9 @@ def button_callbacks(app):
             pitch_shift += 1
 
         # Set the new the pitch shift to the selected track
-        track.pitch_shift = pitch_shift
-        track.apply_effects_async()
+        loop_machine.set_track_params(track_index, pitch_shift=pitch_shift)
 
-        new_pitch_text = f"Pitch: {track.pitch_shift}"
+        new_pitch_text = f"Pitch: {pitch_shift}"
         return new_pitch_text
 
     @app.callback(
@@ -249,33 +304,81 @@ def button_callbacks(app):
         """Deletes the current loop."""
         button_id = get_button_id()
         if "delete_loop_trash_button" == button_id or "delete_loop_button" == button_id:
-            track_list = loop_machine.tracks
-            # Deletes everything in the list by clearing it
-            track_list.clear()
-            updated_track_section = Layout().update_track_section(track_list)
+            # Deletes every track, as one edit that can be undone
+            loop_machine.delete_tracks(range(len(loop_machine.tracks)))
+            updated_track_section = Layout().update_track_section(
+                loop_machine.tracks)
             return updated_track_section
 
     @app.callback(
         Output("track_section", "children", allow_duplicate=True),
+        [Input("undo_button", "n_clicks"),
+         Input("redo_button", "n_clicks")],
+        prevent_initial_call=True
+    )
+    def undo_redo(undo_clicks, redo_clicks):
+        """Undoes or redoes the last track edit."""
+        button_id = get_button_id()
+        if button_id == "undo_button":
+            loop_machine.undo()
+        elif button_id == "redo_button":
+            loop_machine.redo()
+        updated_track_section = Layout().update_track_section(
+            loop_machine.tracks, loop_machine.latency_compensation_samples)
+        return updated_track_section
+
+    @app.callback(
+        [Output("track_section", "children", allow_duplicate=True),
+         Output({"type": "left_mute_icon_button", "index": ALL}, "children",
+                allow_duplicate=True),
+         Output({"type": "track_name_input", "index": ALL}, "value",
+                allow_duplicate=True),
+         Output("ui_state_version", "data")],
         Input("track_buffer_poll", "n_intervals"),
+        [State("ui_state_version", "data"),
+         State({"type": "left_mute_icon_button", "index": ALL}, "id"),
+         State({"type": "track_name_input", "index": ALL}, "id")],
         prevent_initial_call=True
     )
-    def refresh_ui(*_):
-        """Refreshes the track section"""
-        if app.layout['track_buffer_modified'].data:
-            app.layout['track_buffer_modified'].data = False
+    def refresh_ui(_, seen_version, mute_ids, name_ids):
+        """Refreshes the track section if the tracks changed since the
+        state version this window last showed. Each window keeps its own
+        version, so every window sees every change.
+
+        Mutes and renames only update the mute buttons and name inputs of
+        the tracks changed: rebuilding the section would reset the
+        buttons' click counts and the name being typed."""
+        version, changes = loop_machine.state_log.changes_since(seen_version)
+        if version == seen_version:
+            raise PreventUpdate
+        unchanged = ([dash.no_update] * len(mute_ids),
+                     [dash.no_update] * len(name_ids))
+        if (changes.get('full') or changes['removed'] or 'order' in changes
+                or any(set(fields) - {'is_muted', 'name'}
+                       for fields in changes['fields'].values())
+                or changes['loop'].keys() & {'frames_per_loop',
+                                             'latency_compensation_samples'}):
             updated_track_section = Layout().update_track_section(
                 loop_machine.tracks, loop_machine.latency_compensation_samples)
-            return updated_track_section
-        else:
-            return dash.no_update
-
-    def trigger_on_track_buffer_modified(track):
-        """Keeps track of track buffer if it is modified or not."""
-        current_value = app.layout['track_buffer_modified'].data
-        app.layout['track_buffer_modified'].data = True
-
-    loop_machine.on_track_buffer_modified = trigger_on_track_buffer_modified
+            return (updated_track_section, *unchanged, version)
+        if not changes['fields']:
+            return (dash.no_update, *unchanged, version)
+        # Unchanged order, so the track uids give the indices
+        indices = {uid: index for index, uid
+                   in enumerate(loop_machine.state_log.snapshot()[1]['order'])}
+        icons, names = unchanged
+        for uid, fields in changes['fields'].items():
+            index = indices.get(uid)
+            track = changes['tracks'][uid]
+            if 'is_muted' in fields and index is not None:
+                icons = [Layout.mute_icon(track['is_muted'])
+                         if mute_id['index'] == index else icon
+                         for mute_id, icon in zip(mute_ids, icons)]
+            if 'name' in fields and index is not None:
+                names = [track['name'] or ""
+                         if name_id['index'] == index else name
+                         for name_id, name in zip(name_ids, names)]
+        return dash.no_update, icons, names, version
 
 
 def offset_callbacks(app):
@@ -326,8 +429,8 @@ def offset_callbacks(app):
             raise PreventUpdate
 
         button_id = get_button_id()
-        # Get initial bpm
-        bpm = loop_machine.bpm
+        # Get initial bpm; a previous change may still be rendering
+        bpm = loop_machine.target_bpm
         # Decrease bpm by 10
         if decrease_bpm and button_id == "decrease_bpm_button":
             bpm -= 10
@@ -339,6 +442,36 @@ def offset_callbacks(app):
         loop_machine.set_bpm(bpm)
         return f"BPM: {bpm}"
 
+    @app.callback(
+        Output("quantize_button", "children"),
+        Input("quantize_button", "n_clicks"),
+        prevent_initial_call=True
+    )
+    def toggle_quantize(n_clicks):
+        """
+        Cycles when track edits take effect: right away, or at the next
+        beat, bar or loop boundary.
+        """
+        options = QUANTIZE_OPTIONS
+        next_index = (options.index(loop_machine.quantize) + 1) % len(options)
+        loop_machine.quantize = options[next_index]
+        label = (loop_machine.quantize or "off").capitalize()
+        return html.Span(className="bounce-text",
+                         children=f"Quantize: {label}")
+
+    @app.callback(
+        Output("render_progress_text", "children"),
+        Input("track_buffer_poll", "n_intervals"),
+        prevent_initial_call=True
+    )
+    def render_progress(*_):
+        """Shows how many tracks a tempo change has rendered so far."""
+        progress = loop_machine.render_progress
+        if progress is None:
+            return ""
+        done, total = progress
+        return f"Rendering {done}/{total}"
+
     @app.callback(
         [Output("track_section", "children", allow_duplicate=True),
          Output("latency_text", "children")],
@@ -399,11 +532,28 @@ def offset_callbacks(app):
             offset_beats += 0.5
 
         # Set the new beats offset to the selected track
-        track.offset_beats = offset_beats
-        track.apply_effects_async()
-        new_beats_text = f"Offset Beats: {track.offset_beats}"
+        loop_machine.set_track_params(track_index, offset_beats=offset_beats)
+        new_beats_text = f"Offset Beats: {offset_beats}"
         return new_beats_text
 
+    @app.callback(
+        Output({"type": "stretch_engine_text", "index": MATCH}, "children"),
+        Input({"type": "stretch_engine_button", "index": MATCH}, "n_clicks"),
+        prevent_initial_call=True
+    )
+    def toggle_stretch_engine(n_clicks):
+        """
+        Switches a track to the next time-stretch engine: librosa's phase
+        vocoder or the beat-synchronous WSOLA engine for percussive loops.
+        """
+        track_index, _ = get_track_index_button_id()
+        track = loop_machine.tracks[track_index]
+        engines = effects.STRETCH_ENGINES
+        next_index = (engines.index(track.stretch_engine) + 1) % len(engines)
+        loop_machine.set_track_params(track_index,
+                                      stretch_engine=engines[next_index])
+        return f"Stretch: {engines[next_index]}"
+
 
 def load_save(app):
     """Callbacks for loading and saving a loop."""
@@ -418,6 +568,45 @@ def load_save(app):
             loop_machine.save()
         return dash.no_update
 
+    @app.callback(
+        Output("import_upload", "contents"),
+        Input("import_upload", "contents"),
+        State("import_upload", "filename"),
+        prevent_initial_call=True
+    )
+    def import_files(contents, filenames):
+        """
+        Imports uploaded audio files as new tracks. The track section
+        refreshes once each track is decoded.
+        """
+        if not contents:
+            raise PreventUpdate
+        for content, filename in zip(contents, filenames):
+            # Contents are "data:<type>;base64,<data>"
+            data = base64.b64decode(content.split(",", 1)[1])
+            # A directory per upload, so same-named files uploaded at once
+            # from several windows don't overwrite each other while they
+            # decode; the file keeps its name for the track's
+            upload_dir = os.path.join("loops", "imports", "uploads",
+                                      str(uuid.uuid4()))
+            os.makedirs(upload_dir, exist_ok=True)
+            path = os.path.join(upload_dir, os.path.basename(filename))
+            with open(path, "wb") as file:
+                file.write(data)
+            loop_machine.import_track(path)
+        # Clear the upload so the same file can be imported again
+        return None
+
+    @app.callback(
+        Output("export_button", "children"),
+        Input("export_button", "n_clicks"),
+        prevent_initial_call=True
+    )
+    def export_loop(n_clicks):
+        """Exports the loop's mixdown and stems to the 'exports' directory."""
+        loop_machine.export(mixdown=True, stems=True)
+        return dash.no_update
+
     @app.callback(
         [Output("track_section", "children", allow_duplicate=True),
          Output("files_modal", "is_open"),
@@ -426,16 +615,17 @@ def load_save(app):
          Output("latency_text", "children", allow_duplicate=True),
          Output("pkl_files", "options")],
         [Input("files_button", "n_clicks"),
-         Input("load_files_modal", "n_clicks")],
+         Input("load_files_modal", "n_clicks"),
+         Input("scene_files_modal", "n_clicks")],
         [State("files_modal", "is_open"),
          State("pkl_files", "value")],
         prevent_initial_call=True
     )
-    def load_files(n1, n2, is_open, filename):
+    def load_files(n1, n2, n3, is_open, filename):
         """
         Opens and closes the files modal.
         Also loads the selected .pkl file and displays the track
-        in track section.
+        in track section, or queues it as a scene.
         """
         button_id = get_button_id()
         if button_id == "files_button":
@@ -459,8 +649,79 @@ def load_save(app):
             latency = latency_comp / loop_machine.rate
             updated_track_section = Layout().update_track_section(track_list, latency_comp)
             return updated_track_section, False, f"Beats Per Loop: {bpl}", f"BPM: {bpm}", "Latency (s): {:.2f}".format(latency), dash.no_update
+        # Queue the selected .pkl file to play from the end of the loop
+        if button_id == "scene_files_modal" and filename:
+            # Scenes played before are still in memory
+            if (filename in loop_machine.scenes.names()
+                    or loop_machine.add_scene(filename, filename)):
+                loop_machine.switch_scene(filename)
+            return dash.no_update, False, dash.no_update, dash.no_update, dash.no_update, dash.no_update
         return dash.no_update, is_open, dash.no_update, dash.no_update, dash.no_update, dash.no_update,
 
+    shown_scene = {"name": None}
+
+    @app.callback(
+        [Output("scene_text", "children"),
+         Output("bpl_text", "children", allow_duplicate=True),
+         Output("bpm_text", "children", allow_duplicate=True),
+         Output("latency_text", "children", allow_duplicate=True)],
+        Input("track_buffer_poll", "n_intervals"),
+        prevent_initial_call=True
+    )
+    def scene_status(*_):
+        """Shows the scene playing and its settings once it has switched."""
+        name = loop_machine.scene_name
+        if name == shown_scene["name"]:
+            raise PreventUpdate
+        shown_scene["name"] = name
+        latency = loop_machine.latency_compensation_samples / loop_machine.rate
+        return (f"Scene: {name}" if name else "",
+                f"Beats Per Loop: {loop_machine.beats_per_loop}",
+                f"BPM: {loop_machine.bpm}",
+                "Latency (s): {:.2f}".format(latency))
+
+
+def control_api(app):
+    """Local JSON endpoint for controller scripts and MIDI bridges."""
+    @app.server.route("/api/batch", methods=["POST"])
+    def apply_batch():
+        """
+        Applies a JSON list of track edits with one render and one UI
+        refresh, see 'LoopMachine.apply_batch'. Only local clients may
+        change the loop.
+        """
+        if flask.request.remote_addr not in ("127.0.0.1", "::1"):
+            flask.abort(403)
+        edits = flask.request.get_json(silent=True)
+        if not isinstance(edits, list):
+            return flask.jsonify(error="Expected a JSON list of edits."), 400
+        try:
+            rendered = loop_machine.apply_batch(edits)
+        except ValueError as error:
+            return flask.jsonify(error=str(error)), 400
+        return flask.jsonify(rendered=rendered)
+
+    @app.server.route("/api/state")
+    def engine_state():
+        """
+        Returns the versioned loop state, see 'StateLog'. With '?since=N'
+        only what changed since version N is returned. The version is the
+        ETag, so polling with If-None-Match costs a 304 until it changes.
+        """
+        since = flask.request.args.get("since", type=int)
+        state_log = loop_machine.state_log
+        if since is None:
+            version, state = state_log.snapshot()
+        else:
+            version, state = state_log.changes_since(since)
+        etag = f"{loop_machine.uid}-{version}"
+        if flask.request.if_none_match.contains(etag):
+            return flask.Response(status=304, headers={"ETag": f'"{etag}"'})
+        response = flask.jsonify(dict(state, version=version))
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = "no-cache"
+        return response
+
 
 def playhead_callback(app):
     """Callbacks for playhead animation."""
@@ -477,3 +738,54 @@ def playhead_callback(app):
         if playhead_position == 0:
             return {"left": "260px"}
         return {"left": f"calc(260px + ({playhead_position} * (100% - 260px)))"}
+
+
+def meter_style(level):
+    """Returns the style of a meter bar: its width shows the peak over the
+    last 60 dB, the brighter part the RMS level, and it turns red if the
+    level clipped."""
+    if level is None:
+        return {"width": "0%"}
+    peak, rms, clipped = level
+    peak_width = min(max(peak / 60 + 1, 0), 1) * 100
+    rms_width = min(max(rms / 60 + 1, 0), 1) * 100
+    rms_share = rms_width / peak_width * 100 if peak_width else 0
+    color, dim_color = (("#e5534b", "#a5302a") if clipped
+                        else ("#57ab5a", "#2f6f35"))
+    return {"width": f"{peak_width:.0f}%",
+            "background": f"linear-gradient(to right, {color} "
+                          f"{rms_share:.0f}%, {dim_color} {rms_share:.0f}%)"}
+
+
+def meter_callbacks(app):
+    """Callbacks for the level meters."""
+    @app.callback(
+        [Output({"type": "track_meter", "uid": ALL}, "style"),
+         Output("master_meter", "style"),
+         Output("clip_button", "children")],
+        Input("meter_poll", "n_intervals"),
+        State({"type": "track_meter", "uid": ALL}, "id"),
+        prevent_initial_call=True
+    )
+    def update_meters(_, meter_ids):
+        """Shows the levels of the last completed meter period."""
+        meter = loop_machine.meter
+        # Keyed by track uid, so a meter never shows another track's
+        # levels after tracks were added or deleted
+        levels = meter.read()
+        track_levels = {str(uid): level
+                        for uid, level in levels['tracks'].items()}
+        styles = [meter_style(track_levels.get(meter_id['uid']))
+                  for meter_id in meter_ids]
+        return (styles, meter_style(levels['master']),
+                f"Clips: {meter.master_clips}")
+
+    @app.callback(
+        Output("clip_button", "children", allow_duplicate=True),
+        Input("clip_button", "n_clicks"),
+        prevent_initial_call=True
+    )
+    def reset_clips(_):
+        """Resets the clip counter."""
+        loop_machine.meter.reset_clips()
+        return "Clips: 0"
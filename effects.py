@@ -0,0 +1,488 @@
+import atexit
+import concurrent.futures
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+import os
+import threading
+import weakref
+
+# Persist numba's compiled librosa functions next to the app, so only the
+# very first run pays for compiling them (even if site-packages is
+# read-only). Must be set before numba is imported.
+os.environ.setdefault("NUMBA_CACHE_DIR", os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), ".numba_cache"))
+
+STRETCH_ENGINES = ("librosa", "wsola")  # Time-stretch engines per track
+# Bump when a change here changes rendered audio, so renders cached on
+# disk by an older version are not reused (see 'render_cache')
+RENDER_VERSION = 3
+
+# Beat-synchronous WSOLA settings, in samples
+WSOLA_FRAME = 1024
+WSOLA_HOP = WSOLA_FRAME // 2  # Synthesis hop
+WSOLA_TOLERANCE = 256  # How far a frame may move to line up its waveform
+WSOLA_DECIMATION = 4  # Coarse search step before the fine search
+WSOLA_SEAM = 64  # Fade-out of a beat's tail into the next beat
+
+# Beat-sliced renders of one track, see 'render_effects_sliced'
+SLICE_MIN_SECONDS = 4  # Shorter loops are rendered in one piece
+SLICE_MARGIN_SECONDS = 0.1  # Context rendered on both sides of a slice
+SLICE_CROSSFADE = 256  # Crossfade between neighbouring slices, in samples
+SLICE_ALIGNMENT = 128  # How far a slice may move to line up, in samples
+
+# Created on first use by 'get_process_pool'
+_process_pool = None
+_low_priority_pool = None
+
+_shared = {}  # id(array) -> (weak reference, block) of 'shared_zeros' arrays
+_shared_lock = threading.Lock()
+
+
+def render_effects(raw_buffer, sample_rate: int, bpm: float,
+                   original_bpm: float, pitch_shift: int,
+                   offset_beats: float, stretch_engine: str = "librosa"):
+    """Applies time stretching, pitch shifting and the beat offset to a raw
+    int16 buffer and returns the rendered int16 buffer.
+
+    'stretch_engine' picks the time stretch: librosa's phase vocoder, or
+    'wsola_time_stretch', which keeps the loop on its beat grid.
+    """
+    # Imported on first use: librosa.effects pulls in numba and scipy
+    import librosa.effects
+
+    # Normalize and flatten the raw buffer.
+    y = raw_buffer.astype(np.float32) / 32767.0
+    y = y.flatten()
+
+    # Apply time stretching if BPM has changed.
+    if original_bpm != bpm:
+        # Calculate stretch factor: new BPM divided by original BPM.
+        # For example, if originally recorded at 120 BPM and now at 100 BPM,
+        # the factor will be 100/120 ≈ 0.833, which slows down the audio.
+        stretch_factor = bpm / original_bpm
+        if stretch_engine == "wsola":
+            beats = loop_beats(len(y), original_bpm, sample_rate)
+            y = wsola_time_stretch(
+                y, beats, int((60 / bpm) * beats * sample_rate))
+        else:
+            y = librosa.effects.time_stretch(y, rate=stretch_factor)
+
+    # Apply pitch shifting if needed.
+    if pitch_shift != 0:
+        y = librosa.effects.pitch_shift(
+            y, sr=sample_rate, n_steps=pitch_shift)
+
+    # Apply offset if needed.
+    if offset_beats != 0:
+        offset_samples = int(offset_beats * (60 / bpm) * sample_rate)
+        y = np.roll(y, -offset_samples)
+
+    # Convert back to int16.
+    return (np.clip(y, -1, 1) * 32767).astype(np.int16).reshape(-1, 1)
+
+
+def loop_beats(frames: int, bpm: float, sample_rate: int):
+    """Returns how many beats a loop of 'frames' recorded at 'bpm' holds."""
+    return max(1, round(frames * bpm / (60 * sample_rate)))
+
+
+def wsola_time_stretch(y, beats: int, out_frames: int):
+    """Time-stretches a loop of 'beats' beats to exactly 'out_frames'
+    samples with beat-synchronous WSOLA (waveform similarity overlap-add).
+
+    Every beat is stretched on its own and starts exactly on its beat, with
+    its first half frame copied unwindowed, so hits stay on the grid and
+    sharp. Within a beat, each frame is moved by up to 'WSOLA_TOLERANCE'
+    samples to best continue the previous one, without reading past the
+    end of its beat. All beats are processed together, so the loop runs
+    once per frame of a single beat.
+
+    Keyword arguments:
+    y -- float samples of the loop, 1-D; treated as circular
+    """
+    frame, hop, tolerance = WSOLA_FRAME, WSOLA_HOP, WSOLA_TOLERANCE
+    in_onsets = (np.arange(beats + 1) * len(y) / beats).astype(int)
+    out_onsets = (np.arange(beats + 1) * out_frames / beats).astype(int)
+    out_lengths = np.diff(out_onsets)
+    speed = np.diff(in_onsets) / np.maximum(out_lengths, 1)
+    frames_per_beat = int(np.ceil(out_lengths.max() / hop)) + 1
+
+    # Pad circularly so every frame and search region can be read
+    right_pad = int(np.ceil(frames_per_beat * hop * speed.max())) + \
+        tolerance + 2 * frame
+    padded = np.pad(y.astype(np.float32), (tolerance, right_pad), mode='wrap')
+    windows = np.lib.stride_tricks.sliding_window_view(padded, frame)
+    regions = np.lib.stride_tricks.sliding_window_view(
+        padded, frame + 2 * tolerance)
+    step = WSOLA_DECIMATION
+    fft_size = 1 << int(np.ceil(np.log2((2 * frame + 2 * tolerance) / step)))
+    fine_offsets = np.arange(-step + 1, step)
+
+    window = np.hanning(frame + 1)[:-1].astype(np.float32)
+    first_window = window.copy()
+    first_window[:hop] = 1  # Keep the attack of each beat intact
+    synth_length = (frames_per_beat - 1) * hop + frame
+    out = np.zeros((beats, synth_length), dtype=np.float32)
+    window_sum = np.zeros(synth_length, dtype=np.float32)
+
+    starts = in_onsets[:-1] + tolerance  # Frame positions within 'padded'
+    for index in range(frames_per_beat):
+        if index == 0:
+            frame_window = first_window
+        else:
+            frame_window = window
+            nominal = in_onsets[:-1] + tolerance + np.round(
+                index * hop * speed).astype(int)
+            # Stay inside the beat, so the next hit never leaks in early
+            nominal = np.minimum(nominal, np.maximum(
+                in_onsets[1:] - frame, in_onsets[:-1] + tolerance))
+            # Find the shift that best continues the previous frame: a
+            # coarse search on every 'WSOLA_DECIMATION'th sample, then a
+            # fine search around its best shift
+            continuation = windows[starts + hop]
+            search = regions[nominal - tolerance]
+            correlation = np.fft.irfft(
+                np.fft.rfft(search[:, ::step], fft_size) *
+                np.conj(np.fft.rfft(continuation[:, ::step], fft_size)),
+                fft_size)
+            coarse = np.argmax(
+                correlation[:, :2 * tolerance // step + 1], axis=1) * step
+            shifts = np.clip(coarse[:, None] + fine_offsets, 0,
+                             2 * tolerance)
+            candidates = windows[nominal[:, None] - tolerance + shifts]
+            fine = np.einsum('bsn,bn->bs', candidates, continuation)
+            shift = shifts[np.arange(beats), np.argmax(fine, axis=1)]
+            starts = nominal - tolerance + shift
+        position = index * hop
+        out[:, position:position + frame] += windows[starts] * frame_window
+        window_sum[position:position + frame] += frame_window
+    out /= np.maximum(window_sum, 1e-3)
+
+    # Place each beat on the grid, crossfading its tail into the next
+    # beat's start, so the two sum to unity gain
+    stretched = np.zeros(out_frames + WSOLA_SEAM, dtype=np.float32)
+    fade_out = np.linspace(1, 0, WSOLA_SEAM, endpoint=False, dtype=np.float32)
+    fade_in = 1 - fade_out
+    for beat in range(beats):
+        onset, length = out_onsets[beat], out_lengths[beat]
+        seam = min(WSOLA_SEAM, length)
+        out[beat, :seam] *= fade_in[:seam]
+        stretched[onset:onset + length] += out[beat, :length]
+        stretched[onset + length:onset + length + WSOLA_SEAM] += \
+            out[beat, length:length + WSOLA_SEAM] * fade_out
+    # The last beat's tail wraps around to the start of the loop
+    stretched[:WSOLA_SEAM] += stretched[out_frames:]
+    return stretched[:out_frames]
+
+
+def _stretch_and_shift(y, sample_rate: int, stretch_factor: float,
+                       pitch_shift: int):
+    """Process pool entry point: time-stretches and pitch-shifts one slice
+    of float samples with librosa."""
+    import librosa.effects
+
+    if stretch_factor != 1:
+        y = librosa.effects.time_stretch(y, rate=stretch_factor)
+    if pitch_shift != 0:
+        y = librosa.effects.pitch_shift(y, sr=sample_rate, n_steps=pitch_shift)
+    return y
+
+
+def render_effects_sliced(raw_buffer, sample_rate: int, bpm: float,
+                          original_bpm: float, pitch_shift: int,
+                          offset_beats: float, stretch_engine: str = "librosa"):
+    """Renders like 'render_effects', but splits the loop at beat
+    boundaries into one slice per core and renders the slices in the
+    process pool.
+
+    Each slice is rendered with 'SLICE_MARGIN_SECONDS' of context on both
+    sides (the loop is circular). Neighbouring slices are lined up by
+    cross-correlation and joined with a 'SLICE_CROSSFADE' crossfade inside
+    that context. Short loops, and renders librosa has no part in, are
+    rendered in one piece by one process, like 'render_batch' does.
+    """
+    y = raw_buffer.astype(np.float32).flatten() / 32767.0
+    beats = loop_beats(len(y), original_bpm, sample_rate)
+    slices = min(beats, os.cpu_count() or 1)
+    stretch_factor = bpm / original_bpm
+    uses_librosa = pitch_shift != 0 or (
+        stretch_factor != 1 and stretch_engine == "librosa")
+    pool = get_process_pool()
+    if (slices < 2 or not uses_librosa
+            or len(y) < SLICE_MIN_SECONDS * sample_rate):
+        return SharedRender(pool, (raw_buffer, bpm, original_bpm, pitch_shift,
+                                   offset_beats, stretch_engine),
+                            sample_rate).result()
+
+    out_frames = rendered_length(len(y), sample_rate, bpm, original_bpm)
+    if stretch_engine == "wsola" and stretch_factor != 1:
+        # Fast enough in one piece; only the pitch shift is sliced
+        y = pool.submit(wsola_time_stretch, y, beats, out_frames).result()
+        stretch_factor = 1
+
+    # Slice boundaries on the beat grid, in input and output samples
+    boundary_beats = np.round(np.arange(slices + 1) * beats / slices)
+    in_bounds = (boundary_beats * len(y) / beats).astype(int)
+    out_bounds = (boundary_beats * out_frames / beats).astype(int)
+    in_margin = int(SLICE_MARGIN_SECONDS * sample_rate)
+    out_margin = int(round(in_margin / stretch_factor))
+
+    futures = []
+    for index in range(slices):
+        context = np.arange(in_bounds[index] - in_margin,
+                            in_bounds[index + 1] + in_margin)
+        futures.append(pool.submit(
+            _stretch_and_shift, np.take(y, context, mode='wrap'),
+            sample_rate, stretch_factor, pitch_shift))
+
+    crossfade, search = SLICE_CROSSFADE, SLICE_ALIGNMENT
+    fade_in = np.linspace(0, 1, crossfade, endpoint=False, dtype=np.float32)
+    fade_out = 1 - fade_in
+    stitched = np.zeros(out_frames + crossfade, dtype=np.float32)
+
+    def best_offset(rendered, nominal, target):
+        """Returns where in 'rendered', within 'search' of 'nominal', the
+        waveform best lines up with 'target'."""
+        candidates = np.lib.stride_tricks.sliding_window_view(
+            rendered[nominal - search:nominal + search + crossfade],
+            crossfade)
+        return nominal - search + int(np.argmax(candidates @ target))
+
+    for index, future in enumerate(futures):
+        start, end = out_bounds[index], out_bounds[index + 1]
+        rendered = future.result()
+        # Slices are rendered separately, so their phases differ: start
+        # each one where it best lines up with the previous one's end
+        offset = out_margin
+        if index > 0:
+            offset = best_offset(rendered, offset,
+                                 stitched[start:start + crossfade])
+        # The slice's own beats plus the start of the next slice's
+        positions = offset + np.arange(end - start + crossfade)
+        if index == slices - 1:
+            # The last slice must also line up with the first one's start,
+            # so read it at a (very slightly) changed speed
+            wrap = best_offset(rendered, offset + end - start,
+                               stitched[:crossfade])
+            positions = offset + np.arange(len(positions)) * \
+                (wrap - offset) / (end - start)
+        piece = np.interp(positions, np.arange(len(rendered)), rendered,
+                          right=0).astype(np.float32)
+        if index > 0:
+            stitched[start:start + crossfade] *= fade_out
+            piece[:crossfade] *= fade_in
+        stitched[start:start + len(piece)] += piece
+    # The last slice runs on into the start of the loop
+    stitched[:crossfade] = stitched[:crossfade] * fade_in + \
+        stitched[out_frames:] * fade_out
+    y = stitched[:out_frames]
+
+    if offset_beats != 0:
+        offset_samples = int(offset_beats * (60 / bpm) * sample_rate)
+        y = np.roll(y, -offset_samples)
+    rendered = shared_zeros((out_frames, 1))
+    rendered[:, 0] = np.clip(y, -1, 1) * 32767
+    return rendered
+
+
+def shared_zeros(shape, dtype=np.int16):
+    """Returns a zeroed array in a shared memory block of its own, which
+    other processes can map by its 'shared_name' while the array lives.
+    The block is released when the array is collected."""
+    size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    block = shared_memory.SharedMemory(create=True, size=max(1, size))
+    return _share(block, shape, dtype)
+
+
+def shared_name(array):
+    """Returns the name of the shared memory block holding 'array' if it
+    was made by 'shared_zeros' or rendered by 'SharedRender', or None."""
+    with _shared_lock:
+        known = _shared.get(id(array))
+    if known and known[0]() is array:
+        return known[1].name
+    return None
+
+
+def _share(block, shape, dtype):
+    """Returns an array over 'block', which it releases when collected."""
+    array = np.ndarray(shape, dtype, buffer=block.buf)
+    array_id = id(array)
+
+    def on_collected(reference):
+        with _shared_lock:
+            if array_id in _shared and _shared[array_id][0] is reference:
+                del _shared[array_id]
+        block.close()
+        _unlink(block)
+
+    with _shared_lock:
+        _shared[array_id] = (weakref.ref(array, on_collected), block)
+    return array
+
+
+def _unlink(block):
+    try:
+        block.unlink()
+    except FileNotFoundError:
+        pass  # Already unlinked at exit
+
+
+@atexit.register
+def _unlink_shared():
+    """Removes the names of the blocks still in use at exit; mappings of
+    them stay valid until the process is gone."""
+    with _shared_lock:
+        blocks = [block for _, block in _shared.values()]
+    for block in blocks:
+        _unlink(block)
+
+
+def prewarm(sample_rate: int):
+    """Starts the render processes and runs every librosa path
+    'render_effects' uses once on a second of silence in each, so the
+    first real render doesn't pay for loading them."""
+    dummy_buffer = np.zeros((sample_rate, 1), dtype=np.int16)
+    pool = get_process_pool()
+    concurrent.futures.wait([
+        pool.submit(render_effects, dummy_buffer, sample_rate, 110, 100, 1,
+                    0.5)
+        for _ in range(os.cpu_count() or 1)])
+
+
+def rendered_length(frames: int, sample_rate: int, bpm: float,
+                    original_bpm: float):
+    """Returns the loop length in frames at 'bpm' of a raw buffer of
+    'frames' recorded at 'original_bpm'."""
+    beats = loop_beats(frames, original_bpm, sample_rate)
+    return int((60 / bpm) * beats * sample_rate)
+
+
+def get_process_pool(low_priority: bool = False):
+    """Returns the process pool shared by all batch renders, or the single
+    low priority worker used for speculative renders.
+
+    Workers are spawned rather than forked: forking while the audio, Dash
+    and effect threads hold locks can deadlock the child.
+    """
+    global _process_pool, _low_priority_pool
+    context = multiprocessing.get_context("spawn")
+    if low_priority:
+        if _low_priority_pool is None:
+            _low_priority_pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=1, mp_context=context,
+                initializer=_lower_priority)
+        return _low_priority_pool
+    if _process_pool is None:
+        _process_pool = concurrent.futures.ProcessPoolExecutor(
+            mp_context=context)
+    return _process_pool
+
+
+def shutdown_process_pools():
+    """Stops the render processes. Needed before a process that isn't the
+    main process exits, which otherwise waits for the workers forever."""
+    global _process_pool, _low_priority_pool
+    for pool in (_process_pool, _low_priority_pool):
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+    _process_pool = _low_priority_pool = None
+
+
+def _lower_priority():
+    """Process pool initializer: lets every other process run first."""
+    if hasattr(os, 'nice'):
+        os.nice(19)
+
+
+def _render_to_shared_memory(name: str, length: int, raw_buffer, *args):
+    """Process pool entry point: renders a buffer and writes exactly
+    'length' frames of it into the shared memory block 'name'."""
+    rendered = render_effects(raw_buffer, *args)
+    block = shared_memory.SharedMemory(name=name)
+    out = np.ndarray((length, 1), dtype=np.int16, buffer=block.buf)
+    copied = min(length, len(rendered))
+    out[:copied] = rendered[:copied]
+    out[copied:] = 0
+    del out
+    block.close()
+
+
+class SharedRender:
+    """A render running in a process pool. The worker writes its result
+    into shared memory, so nothing audio-sized is pickled back."""
+
+    def __init__(self, pool, job, sample_rate: int):
+        """Starts rendering 'job', a tuple of (raw_buffer, bpm,
+        original_bpm, pitch_shift, offset_beats)."""
+        raw_buffer, bpm, original_bpm, *args = job
+        self.length = rendered_length(len(raw_buffer), sample_rate, bpm,
+                                      original_bpm)
+        self.block = shared_memory.SharedMemory(
+            create=True, size=max(1, self.length * 2))
+        self._unlinked = False
+        self._collected = False
+        try:
+            self.future = pool.submit(
+                _render_to_shared_memory, self.block.name, self.length,
+                raw_buffer, sample_rate, bpm, original_bpm, *args)
+        except BaseException:
+            self._release()
+            raise
+
+    def result(self, timeout=None):
+        """Waits for the render and returns the rendered buffer, like
+        'shared_zeros' does. Its memory is released when the array is
+        collected."""
+        try:
+            self.future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            raise
+        except BaseException:
+            self._release()
+            raise
+        self._collected = True
+        return _share(self.block, (self.length, 1), np.int16)
+
+    def cancel(self):
+        """Drops the render, releasing its memory once the worker is done
+        with it. Does nothing once the result has been collected."""
+        if self._collected:
+            return
+        self.future.cancel()
+        self.future.add_done_callback(lambda _: self._release())
+
+    def _unlink(self):
+        """Removes the block's name; the mapping stays valid until closed."""
+        if not self._unlinked:
+            self._unlinked = True
+            self.block.unlink()
+
+    def _release(self):
+        self._unlink()
+        self.block.close()
+
+
+def render_batch(jobs, sample_rate: int, on_progress=None):
+    """Renders many buffers in parallel in the process pool.
+
+    Each job is a tuple of (raw_buffer, bpm, original_bpm, pitch_shift,
+    offset_beats, stretch_engine). Returns the rendered buffers in job order.
+
+    Keyword arguments:
+    on_progress -- called with (jobs_done, jobs_total) as jobs finish
+    """
+    pool = get_process_pool()
+    renders = [SharedRender(pool, job, sample_rate) for job in jobs]
+    try:
+        futures = [render.future for render in renders]
+        for done, _ in enumerate(
+                concurrent.futures.as_completed(futures), start=1):
+            if on_progress:
+                on_progress(done, len(futures))
+        return [render.result() for render in renders]
+    except BaseException:
+        for render in renders:
+            render.cancel()
+        raise
@@ -0,0 +1,106 @@
+import concurrent.futures
+import math
+import numpy as np
+import os
+import re
+import soundfile as sf
+
+EXPORT_FORMATS = ("wav", "flac")
+EXPORT_CHUNK_FRAMES = 1 << 20  # Frames written to the file at a time
+
+
+def track_audio(buffer, beats: int, phase: int, loop_beats: int,
+                frames_per_loop: int, loops: int, latency_samples: int):
+    """Returns 'loops' loops of a track's rendered buffer as they are heard.
+
+    Like playback, each loop starts 'phase' beats into the track, plus
+    'loop_beats' for every loop before it, and reads the buffer
+    'latency_samples' ahead, wrapping at the buffer's own length.
+    """
+    length = len(buffer)
+    if length == 0:
+        return np.zeros(loops * frames_per_loop, dtype=np.int16)
+    starts = (phase + np.arange(loops) * loop_beats) % beats * length // beats
+    indices = (starts[:, np.newaxis] + latency_samples
+               + np.arange(frames_per_loop)) % length
+    return buffer[indices.ravel(), 0]
+
+
+def cycle_loops(beats, loop_beats: int):
+    """Returns after how many loops tracks 'beats' long all line up with
+    the loop again."""
+    loops = 1
+    for track_beats in beats:
+        loops = math.lcm(loops, track_beats // math.gcd(track_beats,
+                                                         loop_beats))
+    return loops
+
+
+def write_repeated(path: str, audio, frames: int, sample_rate: int,
+                   channels: int = 1):
+    """Writes 'frames' frames of 'audio' (int16) repeated to 'path', a few
+    repetitions at a time so long exports don't need the whole file in
+    memory."""
+    repetitions_per_chunk = max(1, EXPORT_CHUNK_FRAMES // max(len(audio), 1))
+    chunk = np.tile(audio, repetitions_per_chunk)
+    if channels > 1:
+        chunk = np.repeat(chunk[:, np.newaxis], channels, axis=1)
+    with sf.SoundFile(path, 'w', samplerate=sample_rate, channels=channels,
+                      subtype='PCM_16') as file:
+        remaining = frames
+        while remaining > 0:
+            count = min(remaining, len(chunk))
+            file.write(chunk[:count])
+            remaining -= count
+
+
+def export_loop(tracks, frames_per_loop: int, loop_beats: int,
+                latency_samples: int, sample_rate: int, prefix: str,
+                repetitions: int = 8, mixdown: bool = True,
+                stems: bool = False, file_format: str = "wav"):
+    """Renders 'repetitions' loops of the tracks offline and writes them to
+    files starting with 'prefix'. Returns the paths written.
+
+    The mixdown is stereo and leaves out muted tracks, like playback. Stems
+    are mono, one per track, and written in parallel. Only the loops until
+    every track lines up with the loop again are rendered; the files
+    repeat them.
+
+    Keyword arguments:
+    tracks -- (name, is_muted, buffer, beats, phase) tuples, with the
+              track's length in beats and how many beats into it the
+              first loop starts; buffers must not change while exporting
+    """
+    if file_format not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format '{file_format}'.")
+    loop_count = min(repetitions, cycle_loops(
+        [beats for _, _, _, beats, _ in tracks], loop_beats))
+    loops = [(name, is_muted,
+              track_audio(buffer, beats, phase, loop_beats, frames_per_loop,
+                          loop_count, latency_samples))
+             for name, is_muted, buffer, beats, phase in tracks]
+    jobs = []
+    if mixdown:
+        mix = np.zeros(loop_count * frames_per_loop, dtype=np.int32)
+        for _, is_muted, loop in loops:
+            if not is_muted:
+                mix += loop
+        mix = np.clip(mix, -32768, 32767).astype(np.int16)
+        jobs.append((f"{prefix}_mix.{file_format}", mix, 2))
+    if stems:
+        for index, (name, _, loop) in enumerate(loops):
+            # Keep track names usable in file names
+            label = re.sub(r'[^\w-]+', '_', name or "Untitled")
+            jobs.append(
+                (f"{prefix}_stem{index}-{label}.{file_format}", loop, 1))
+
+    os.makedirs(os.path.dirname(prefix) or '.', exist_ok=True)
+    # libsndfile releases the GIL while encoding, so threads are enough
+    with concurrent.futures.ThreadPoolExecutor() as pool:
+        futures = [pool.submit(write_repeated, path, loop,
+                               repetitions * frames_per_loop, sample_rate,
+                               channels)
+                   for path, loop, channels in jobs]
+        for future in futures:
+            future.result()
+    return [path for path, _, _ in jobs]
@@ -1,22 +1,61 @@
-from app import app
+import socket
+import startup_timer
 import threading
+import time
 import webview
 
+URL = 'http://127.0.0.1:8050'
+LOADING_HTML = """<body style="background-color: #212529; color: #f0f0f3;
+font-family: Arial, Helvetica, sans-serif;">Loading Ostinato Live...</body>"""
+
 
 def run_program():
     """
     Runs the app on local host with port 8050.
     """
-    app.run('127.0.0.1', port=8050)
+    # Imported here so spawned render processes, which re-import this
+    # module, don't build the app and open an audio stream
+    import app
+    app.run_program()
 
 
-if __name__ == "__main__":
+def wait_for_server(timeout=30):
+    """Waits until the app accepts connections on port 8050."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', 8050), timeout=0.5):
+                return True
+        except OSError:
+            time.sleep(0.05)
+    return False
+
+
+def start_app(window):
+    """
+    Starts the app while the window shows a loading page, then opens the
+    app in the window once it is serving.
+    """
+    def on_app_loaded():
+        """Reports start-up timing once the UI is usable."""
+        window.events.loaded -= on_app_loaded
+        startup_timer.mark("window loaded")
+        startup_timer.report()
+
     threading.Thread(target=run_program, daemon=True).start()
-    # Create a webview window to display the app running on local host
-    # with port 8050
-    webview.create_window('Ostinato Live | Audio Loop Station',
-                          'http://127.0.0.1:8050',
-                          height=800,
-                          width=1300,
-                          maximized=True)
-    webview.start()
+    wait_for_server()
+    startup_timer.mark("server ready")
+    window.events.loaded += on_app_loaded
+    window.load_url(URL)
+
+
+if __name__ == "__main__":
+    # Create a webview window right away; the app running on local host
+    # with port 8050 is loaded into it once it has started
+    window = webview.create_window('Ostinato Live | Audio Loop Station',
+                                   html=LOADING_HTML,
+                                   height=800,
+                                   width=1300,
+                                   maximized=True)
+    startup_timer.mark("window created")
+    webview.start(start_app, window)
@@ -0,0 +1,138 @@
+import atexit
+import cProfile
+from collections import deque
+import functools
+import io
+import os
+import pstats
+import threading
+import time
+
+# Opt-in: set OSTINATO_PROFILE=1 before starting the app or LoopMachine.
+# When off, 'profiled' returns functions unchanged, so there is no cost.
+ENABLED = os.environ.get("OSTINATO_PROFILE", "") not in ("", "0")
+PROFILE_FILE = "perf_profile.txt"
+DURATIONS_KEPT = 1000  # Recent durations per name, for percentiles
+PROFILE_EVERY = 10  # Every n-th call of each name runs under cProfile
+SLOW_PROFILES_KEPT = 3  # Profiles of the slowest sampled calls per name
+
+_stats = {}  # Name -> {'count', 'durations', 'profiles'}
+_lock = threading.Lock()
+_local = threading.local()  # Set while a call is being profiled
+
+
+def _entry(name: str):
+    with _lock:
+        return _stats.setdefault(name, {
+            'count': 0,
+            'durations': deque(maxlen=DURATIONS_KEPT),
+            'profiles': [],  # (seconds, pstats text), slowest first
+        })
+
+
+def _call(name: str, function, args, kwargs):
+    entry = _entry(name)
+    with _lock:
+        entry['count'] += 1
+        sample = (entry['count'] % PROFILE_EVERY == 1
+                  and not getattr(_local, 'profiling', False))
+    profile = cProfile.Profile() if sample else None
+    if profile:
+        _local.profiling = True
+        profile.enable()
+    start = time.perf_counter()
+    try:
+        return function(*args, **kwargs)
+    finally:
+        seconds = time.perf_counter() - start
+        if profile:
+            profile.disable()
+            _local.profiling = False
+        with _lock:
+            entry['durations'].append(seconds)
+            profiles = entry['profiles']
+            is_slow = (len(profiles) < SLOW_PROFILES_KEPT
+                       or seconds > profiles[-1][0])
+        if profile and is_slow:
+            text = io.StringIO()
+            pstats.Stats(profile, stream=text).sort_stats(
+                'cumulative').print_stats(20)
+            with _lock:
+                profiles.append((seconds, text.getvalue()))
+                profiles.sort(key=lambda item: -item[0])
+                del profiles[SLOW_PROFILES_KEPT:]
+
+
+def profiled(name: str):
+    """Decorator that times every call under 'name' when profiling is
+    enabled, and profiles a sample of the calls."""
+    def decorator(function):
+        if not ENABLED:
+            return function
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            return _call(name, function, args, kwargs)
+        return wrapper
+    return decorator
+
+
+def profile_callbacks(app):
+    """Times every callback registered on the Dash 'app' so far, under
+    the name of its function."""
+    if not ENABLED:
+        return
+    for callback in app.callback_map.values():
+        function = callback['callback']
+        callback['callback'] = profiled(
+            f"callback {function.__name__}")(function)
+
+
+def _percentile(durations, fraction: float):
+    ordered = sorted(durations)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+def report(with_profiles: bool = False):
+    """Returns a table of call counts and p50/p99 latency per name,
+    slowest p99 first, optionally followed by the slowest profiles."""
+    with _lock:
+        entries = [(name, entry['count'], list(entry['durations']),
+                    list(entry['profiles']))
+                   for name, entry in _stats.items() if entry['durations']]
+    entries.sort(key=lambda entry: -_percentile(entry[2], 0.99))
+    lines = [f"{'Name':<40} {'Calls':>7} {'p50 (ms)':>9} {'p99 (ms)':>9}"]
+    for name, count, durations, _ in entries:
+        lines.append(f"{name:<40} {count:>7} "
+                     f"{_percentile(durations, 0.5) * 1000:>9.1f} "
+                     f"{_percentile(durations, 0.99) * 1000:>9.1f}")
+    if with_profiles:
+        for name, _, _, profiles in entries:
+            for seconds, text in profiles:
+                lines.append(f"\n== {name}: {seconds * 1000:.1f} ms ==")
+                lines.append(text)
+    return "\n".join(lines)
+
+
+def dump(path: str = PROFILE_FILE):
+    """Writes the report with the slowest profiles to 'path'."""
+    with open(path, 'w') as file:
+        file.write(report(with_profiles=True))
+
+
+def debug_route(app):
+    """Serves the report with profiles on the local '/debug/perf' route."""
+    if not ENABLED:
+        return
+    import flask
+
+    @app.server.route('/debug/perf')
+    def debug_perf():
+        if flask.request.remote_addr not in ('127.0.0.1', '::1'):
+            flask.abort(403)
+        return flask.Response(report(with_profiles=True),
+                              mimetype='text/plain')
+
+
+if ENABLED:
+    atexit.register(dump)
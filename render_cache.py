@@ -0,0 +1,175 @@
+import blob_store
+import effects
+import glob
+import hashlib
+import numpy as np
+import os
+import perf_profile
+import threading
+import weakref
+
+RENDER_CACHE_DIR = os.path.join("loops", "renders")
+RENDER_CACHE_BYTES = 1024 * 1024 * 1024  # Least recently used renders go first
+# Render methods; sliced and whole renders differ at slice seams
+SLICED = 'sliced'  # 'effects.render_effects_sliced'
+WHOLE = 'whole'  # 'effects.render_effects', as 'effects.render_batch' uses
+
+_keys = {}  # id(buffer) -> (weak reference, key) of renders on disk
+_keys_lock = threading.Lock()
+
+
+def render_key(raw_buffer, sample_rate: int, effect_state, method=SLICED):
+    """Returns the cache key for rendering 'raw_buffer' with
+    'effect_state', as returned by 'Track.effect_state', with render
+    'method' SLICED or WHOLE."""
+    key = (f'{blob_store.digest(raw_buffer)}-{sample_rate}-'
+           f'{tuple(effect_state)}-{method}-{effects.RENDER_VERSION}')
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def _path(key: str):
+    return os.path.join(RENDER_CACHE_DIR, f'{key}.npy')
+
+
+def key_of(buffer):
+    """Returns the key of 'buffer' if it was written to or read from the
+    cache, or None. Neither hashes the buffer nor touches the disk."""
+    with _keys_lock:
+        known = _keys.get(id(buffer))
+    if known and known[0]() is buffer:
+        return known[1]
+    return None
+
+
+def _remember(buffer, key):
+    buffer_id = id(buffer)
+
+    def on_collected(_):
+        with _keys_lock:
+            if buffer_id in _keys and _keys[buffer_id][0]() is None:
+                del _keys[buffer_id]
+
+    with _keys_lock:
+        _keys[buffer_id] = (weakref.ref(buffer, on_collected), key)
+
+
+def load(raw_buffer, sample_rate: int, effect_state, method=SLICED):
+    """Returns the cached render, or None."""
+    return load_key(render_key(raw_buffer, sample_rate, effect_state, method))
+
+
+def load_key(key: str):
+    """Returns the cached render with key 'key', or None."""
+    path = _path(key)
+    try:
+        buffer = _read_shared(path)
+    except (FileNotFoundError, ValueError, EOFError):
+        return None
+    try:
+        os.utime(path)  # Marks it as recently used
+    except FileNotFoundError:
+        pass
+    _remember(buffer, key)
+    return buffer
+
+
+def _read_shared(path: str):
+    """Reads a .npy file into shared memory, see 'effects.shared_zeros'."""
+    with open(path, 'rb') as file:
+        version = np.lib.format.read_magic(file)
+        if version == (1, 0):
+            header = np.lib.format.read_array_header_1_0(file)
+        else:
+            header = np.lib.format.read_array_header_2_0(file)
+        shape, fortran_order, dtype = header
+        if fortran_order or dtype.hasobject:
+            raise ValueError(f'{path} is not a rendered buffer.')
+        buffer = effects.shared_zeros(shape, dtype)
+        if file.readinto(memoryview(buffer).cast('B')) != buffer.nbytes:
+            raise EOFError(f'{path} is cut short.')
+    return buffer
+
+
+def store(raw_buffer, sample_rate: int, effect_state, buffer,
+          method=SLICED):
+    """Writes a render to the cache, then evicts the least recently used
+    renders beyond 'RENDER_CACHE_BYTES'."""
+    key = render_key(raw_buffer, sample_rate, effect_state, method)
+    path = _path(key)
+    os.makedirs(RENDER_CACHE_DIR, exist_ok=True)
+    # Written under a temporary name so a partial render is never read
+    temporary_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(temporary_path, 'wb') as file:
+        np.save(file, buffer)
+    os.replace(temporary_path, path)
+    _remember(buffer, key)
+    _evict()
+
+
+def _evict():
+    entries = []
+    for path in glob.glob(os.path.join(RENDER_CACHE_DIR, '*.npy')):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= RENDER_CACHE_BYTES:
+            return
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        # Tracks holding the evicted render pickle it again
+        key = os.path.basename(path)[:-len('.npy')]
+        with _keys_lock:
+            for buffer_id, known in list(_keys.items()):
+                if known[1] == key:
+                    del _keys[buffer_id]
+
+
+def _store_all(renders, sample_rate: int):
+    for raw_buffer, effect_state, buffer in renders:
+        store(raw_buffer, sample_rate, effect_state, buffer, WHOLE)
+
+
+@perf_profile.profiled("render track")
+def render(raw_buffer, sample_rate: int, *effect_state):
+    """Renders like 'effects.render_effects_sliced', reading the render
+    from the cache if it is there and adding it otherwise."""
+    buffer = load(raw_buffer, sample_rate, effect_state)
+    if buffer is None:
+        buffer = effects.render_effects_sliced(raw_buffer, sample_rate,
+                                               *effect_state)
+        store(raw_buffer, sample_rate, effect_state, buffer)
+    return buffer
+
+
+@perf_profile.profiled("render batch")
+def render_batch(jobs, sample_rate: int, on_progress=None):
+    """Renders like 'effects.render_batch', rendering only the jobs whose
+    render isn't cached. New renders are cached in the background."""
+    buffers = [load(job[0], sample_rate, job[1:], WHOLE) for job in jobs]
+    missing = [index for index, buffer in enumerate(buffers)
+               if buffer is None]
+    if not missing:
+        return buffers
+    cached = len(jobs) - len(missing)
+
+    def progress(done, total):
+        on_progress(cached + done, cached + total)
+
+    results = effects.render_batch([jobs[index] for index in missing],
+                                   sample_rate,
+                                   progress if on_progress else None)
+    for index, result in zip(missing, results):
+        buffers[index] = result
+    threading.Thread(
+        target=_store_all,
+        args=([(jobs[index][0], jobs[index][1:], buffers[index])
+               for index in missing], sample_rate),
+        daemon=True).start()
+    return buffers
@@ -0,0 +1,19 @@
+import time
+
+# Start-up is timed from the first import of this module
+_start_time = time.perf_counter()
+_stages = []  # (stage name, seconds since start)
+
+
+def mark(stage: str):
+    """Records that a start-up stage has finished."""
+    _stages.append((stage, time.perf_counter() - _start_time))
+
+
+def report():
+    """Prints how long each start-up stage took."""
+    print("== Start-up timing ==")
+    previous = 0.0
+    for stage, elapsed in _stages:
+        print(f"{stage:<20} {elapsed - previous:6.2f}s  (total {elapsed:.2f}s)")
+        previous = elapsed